@@ -2,6 +2,7 @@
 
 Defines a Panel dashboard for visualizing the native ParticleModel extension
 """
+import asyncio
 import functools
 import os
 import colorcet as cc   # for better colormaps
@@ -12,18 +13,33 @@ import panel as pn      # for dashboarding
 import param as pr      # for a typehint
 from holoviews.streams import Pipe        # for continuously streaming data to the plot
 
-from ParticleModel import MultithreadedParticleSystem  # our C++ model!
+from ParticleModel import MultithreadedParticleSystem, direct_crossover  # our C++ model!
 
 
-def update_model() -> None:
+def get_particle_data() -> pd.DataFrame:
+    """Pack the current particle state into a dataframe.
+
+    The position and mass views alias the model's storage, so the only copy
+    made is the one into the dataframe itself. In single precision that copy
+    is also narrowed to float32, halving what is streamed to the browser.
+
+    Returns:
+        Dataframe of the particle positions and masses
+    """
+    x, y = model.positions
+    return pd.DataFrame({'x': x, 'y': y, 'm': model.masses}, dtype=frame_dtype)
+
+async def update_model() -> None:
     """Callback that is executed by periodic callback managed by the dashboard.
     
-    Update the model by a single step using the time delta. Once updated the
-    model data is packed into a dataframe and sent through the pipe.
+    Update the model by the selected number of steps using the time delta. The
+    steps run off of the event loop (and without the GIL) so other sessions stay
+    responsive while they are computed. Once updated the model data is packed
+    into a dataframe and sent through the pipe.
     """
-    model.update()
-    particle_data = pd.DataFrame([[particle.x, particle.y, particle.m] for particle in model.particles], columns=['x','y','m'])
-    extent_data = pd.DataFrame([extent for extent in model.get_extents()], columns=['x0', 'y0', 'x1', 'y1'])
+    await asyncio.wrap_future(model.step_async(steps_per_frame_slider.value))
+    particle_data = get_particle_data()
+    extent_data = pd.DataFrame(model.get_extents_array(), columns=['x0', 'y0', 'x1', 'y1'])
     particle_pipe.send((particle_data, extent_data))
     table.value = particle_data
 
@@ -77,8 +93,8 @@ def play(event: pr.parameterized.Event) -> None:
         play_button.name = 'Play'
         periodic_callback.stop()
         table.disabled = False
-        particle_data = pd.DataFrame([[particle.x, particle.y, particle.m] for particle in model.particles], columns=['x','y','m'])
-        extent_data = pd.DataFrame([extent for extent in model.get_extents()], columns=['x0', 'y0', 'x1', 'y1'])
+        particle_data = get_particle_data()
+        extent_data = pd.DataFrame(model.get_extents_array(), columns=['x0', 'y0', 'x1', 'y1'])
         particle_pipe.send((particle_data, extent_data))
 
 def reset(event: pr.parameterized.Event | None) -> None:
@@ -91,19 +107,38 @@ def reset(event: pr.parameterized.Event | None) -> None:
         event: the click event (or None when initialized) that triggered the
         callback
     """
-    global model, periodic_callback, framewise
+    global model, periodic_callback, framewise, frame_dtype
     if periodic_callback is not None and periodic_callback.running:
         play_button.name = 'Play'
         periodic_callback.stop()
     periodic_callback = None
-    num_particles = num_particles_slider.value * thread_count_slider.value
-    model = MultithreadedParticleSystem(num_particles, bounds_slider.value, seed_input.value, theta_slider.value, time_delta_slider.value, thread_count_slider.value)
-    for particle in model.particles:
-        r = np.hypot(particle.x, particle.y)
-        if r > 1.0e-8:
-            particle.vx = -particle.y / r
-            particle.vy = particle.x / r
-    particle_data = pd.DataFrame([[particle.x, particle.y, particle.m] for particle in model.particles], columns=['x','y','m'])
+    precision = 'single' if single_precision_toggle.value and not single_precision_toggle.disabled else 'double'
+    model = MultithreadedParticleSystem(
+        num_particles_slider.value,
+        bounds_slider.value,
+        seed_input.value,
+        theta_slider.value,
+        time_delta_slider.value,
+        thread_count_slider.value,
+        softening=0.0 if softening_slider.disabled else softening_slider.value,
+        leaf_size=leaf_size_slider.value,
+        engine=engine_select.value,
+        expansion_order=expansion_order_slider.value,
+        quadrupole=quadrupole_toggle.value and not quadrupole_toggle.disabled,
+        mesh_size=mesh_size_slider.value,
+        refit=refit_slider.value,
+        group_size=group_size_slider.value,
+        precision=precision,
+        affinity='none' if shared_pool_toggle.value else affinity_select.value,
+        shared_pool=shared_pool_toggle.value,
+    )
+    frame_dtype = np.float32 if precision == 'single' else np.float64
+    # unit circular velocities about the origin; the central body stays at rest
+    x, y = model.positions
+    r = np.hypot(x, y)
+    r[r <= 1.0e-8] = np.inf
+    model.set_velocities(-y / r, x / r)
+    particle_data = get_particle_data()
     extent_data = pd.DataFrame({
         'x0':[-bounds_slider.value],
         'y0':[-bounds_slider.value],
@@ -120,19 +155,54 @@ def reset(event: pr.parameterized.Event | None) -> None:
 def open_readme(event):
     app.open_modal()
 
+def resolve_engine() -> str:
+    """Resolve the selected engine the way the model does.
+
+    'auto' picks direct summation below the model's crossover particle count and
+    Barnes-Hut otherwise; every other engine is taken as selected.
+
+    Returns:
+        Name of the engine the model will run with
+    """
+    engine = engine_select.value
+    if engine == 'auto':
+        return 'direct' if num_particles_slider.value < direct_crossover else 'barnes_hut'
+    return engine
+
+def update_engine_options(*events):
+    """Enable only the options that the resolved engine honours.
+
+    Single precision applies to direct summation and the Barnes-Hut group walks,
+    quadrupole moments to Barnes-Hut alone, and softening to every engine but the
+    particle mesh.
+    """
+    engine = resolve_engine()
+    single_precision_toggle.disabled = not (engine == 'direct' or (engine == 'barnes_hut' and group_size_slider.value > 0))
+    quadrupole_toggle.disabled = engine != 'barnes_hut'
+    softening_slider.disabled = engine == 'pm'
+
+async def set_thread_count(event):
+    # resizing waits on any step in flight and may respawn the pool, so keep it off of the event loop
+    await asyncio.to_thread(model.set_num_threads, event.new)
+
 def edit_model(event):
-    if event.column == 'x':
-        model.particles[event.row].x = event.value
-    elif event.column == 'y':
-        model.particles[event.row].y = event.value
+    # edit copies and hand them to the setters, which wait out a running step and refit the
+    # bounds to moved particles; writing the views directly would do neither
+    if event.column in ('x', 'y'):
+        positions = model.positions.copy()
+        positions[0 if event.column == 'x' else 1, event.row] = event.value
+        model.set_positions(positions[0], positions[1])
     elif event.column == 'm':
-        model.particles[event.row].m = event.value
-    particle_data = pd.DataFrame([[particle.x, particle.y, particle.m] for particle in model.particles], columns=['x','y','m'])
-    extent_data = pd.DataFrame([extent for extent in model.get_extents()], columns=['x0', 'y0', 'x1', 'y1'])
+        masses = model.masses.copy()
+        masses[event.row] = event.value
+        model.set_masses(masses)
+    particle_data = get_particle_data()
+    extent_data = pd.DataFrame(model.get_extents_array(), columns=['x0', 'y0', 'x1', 'y1'])
     particle_pipe.send((particle_data, extent_data))
 
-# create a global for the model
+# create a global for the model, and for the precision its frames are sent in
 model = None
+frame_dtype = np.float64
 
 # we use a pipe so that we can stream data from an asynchronous periodic callback
 particle_pipe = Pipe(data=[])
@@ -159,16 +229,32 @@ open_readme_button.on_click(open_readme)
 
 # input widgets for various options
 seed_input = pn.widgets.IntInput(name='Random Seed', value=1337)
-num_particles_slider = pn.widgets.FloatSlider(name='Particles per Thread', start=1, end=1000, step=1, value=100)
+num_particles_slider = pn.widgets.IntSlider(name='Particles', start=1, end=20000, step=1, value=100)
 bounds_slider = pn.widgets.FloatSlider(name='Bounds', start=25, end=2500, value=100, step=25)
 time_delta_slider = pn.widgets.FloatSlider(name='Time Delta (s)', start=0.1, end=1.0, value=0.1, step=0.1)
+softening_slider = pn.widgets.FloatSlider(name='Softening', start=0.0, end=5.0, value=0.0, step=0.1)
 
 theta_slider = pn.widgets.FloatSlider(name='Theta', start=0.0, end=2.0, value=0.5, step=0.1)
-
-thread_count = [2 ** i for i in range(int(np.log2(os.cpu_count())))]
-thread_count_slider = pn.widgets.DiscreteSlider(name='Thread Count', options=thread_count)
+leaf_size_slider = pn.widgets.IntSlider(name='Leaf Size', start=1, end=32, value=8, step=1)
+quadrupole_toggle = pn.widgets.Checkbox(name='Quadrupole Moments')
+single_precision_toggle = pn.widgets.Checkbox(name='Single Precision')
+group_size_slider = pn.widgets.IntSlider(name='Group Size', start=0, end=128, value=32, step=1)
+refit_slider = pn.widgets.FloatSlider(name='Refit Threshold', start=0.0, end=0.5, value=0.0, step=0.01)
+engine_select = pn.widgets.Select(name='Engine', options={'Auto': 'auto', 'Barnes-Hut': 'barnes_hut', 'Fast Multipole': 'fmm', 'Direct': 'direct', 'Particle Mesh': 'pm', 'TreePM': 'treepm'}, value='barnes_hut')
+expansion_order_slider = pn.widgets.IntSlider(name='Expansion Order', start=1, end=12, value=4, step=1)
+mesh_size_slider = pn.widgets.DiscreteSlider(name='Mesh Size', options=[64, 128, 256, 512, 1024], value=256)
+engine_select.param.watch(update_engine_options, 'value')
+group_size_slider.param.watch(update_engine_options, 'value')
+num_particles_slider.param.watch(update_engine_options, 'value')
+
+thread_count_slider = pn.widgets.IntSlider(name='Thread Count', start=1, end=os.cpu_count(), value=1, step=1)
+thread_count_slider.param.watch(set_thread_count, 'value')
+shared_pool_toggle = pn.widgets.Checkbox(name='Share Threads Between Sessions', value=True)
+affinity_select = pn.widgets.Select(name='Thread Placement', options={'Unpinned': 'none', 'Compact': 'compact', 'Scatter': 'scatter'}, value='none', disabled=True)
+shared_pool_toggle.link(affinity_select, value='disabled')
 
 fps_slider = pn.widgets.IntSlider(name='FPS', start=1, end=60, value=30, step=1)
+steps_per_frame_slider = pn.widgets.IntSlider(name='Steps per Frame', start=1, end=20, value=1, step=1)
 quadtree_display = pn.widgets.Toggle(name='Display Quadtree', sizing_mode='stretch_width')
 auto_scale_axes = pn.widgets.Toggle(name='Auto Scale Axes', sizing_mode='stretch_width')
 
@@ -196,19 +282,31 @@ This dashboard visualizes a multithreaded C++ implementation of a Barnes-Hut sim
 
 ### Controls
 
-* `Particles per Thread`: Number of particles to spawn per thread utilized.
+* `Particles`: Number of particles to spawn.
 * `Bounds`: Initial bounds to spawn particles within (lower left and upper right taken as (-b, -b) and (b, b)).
 * `Time Delta (s)`: The size of the time step to use for integration
+* `Softening`: Plummer softening length; smooths out the force between particles closer than this, avoiding blowups during close encounters. Not available with `Particle Mesh`, whose grid already smooths the force.
 
 ---
 
 * `Random Seed`: The initial random seed
 * `Theta`: Barnes-Hut control parameter; lower values improve accuracy but decrease performance. Default of 0.5 provides great balance of realism and performance.
-* `Thread Count`: Number of threads to use
+* `Leaf Size`: Most particles a quadtree cell may hold before it is subdivided; particles sharing a cell interact directly.
+* `Group Size`: Most particles that share a single walk of the quadtree, each summing over the same list of cells and particles. 0 walks the tree once per particle.
+* `Refit Threshold`: When above 0, the quadtree is adjusted to the particles' new positions instead of being rebuilt every step, until walking it takes this fraction more work than walking a fresh one. Only pays off when rebuilding is a large part of a step; fast-moving particles loosen the tree quickly.
+* `Single Precision`: Sum the interactions between particles in single precision (the particles themselves are still stored and moved in double precision), and send frames to the browser in single precision. Only available with the `Direct` engine, or with `Barnes-Hut` and a `Group Size` above 0; with `Auto`, it follows whichever of the two is picked.
+* `Quadrupole Moments`: Treat distant quadtree cells as a point mass plus a quadrupole, rather than a point mass alone. This is about as accurate at a `Theta` of 1.0 as the point mass alone is at 0.5, for fewer interactions. Only available with `Barnes-Hut`, or with `Auto` when it picks `Barnes-Hut`.
+* `Engine`: How forces are accumulated. `Barnes-Hut` walks the quadtree once per particle; `Fast Multipole` lets whole cells exchange multipole expansions, and reaches the same accuracy with a larger `Theta`. `Direct` sums the force between every pair of particles exactly, which is only quick for a few hundred particles. `Particle Mesh` spreads the mass over a grid and takes the forces from it with FFTs; its cost depends on the grid rather than the number of particles, but it blurs out anything smaller than a grid cell. `TreePM` takes only the long-range forces from the grid and adds the short-range ones with a quadtree walk. `Auto` picks `Direct` for small systems and `Barnes-Hut` otherwise.
+* `Expansion Order`: Number of terms kept in the Fast Multipole expansions; higher orders improve accuracy but decrease performance.
+* `Mesh Size`: Grid cells per side for the `Particle Mesh` and `TreePM` engines.
+* `Thread Count`: Number of threads to use; takes effect immediately, even while the simulation is playing.
+* `Share Threads Between Sessions`: Run on one pool of threads (one per core) shared by every session on the server, taking turns with the other sessions, rather than starting threads of its own. `Thread Count` then caps how many of the shared threads this session may use at once.
+* `Thread Placement`: Pin each thread to its own CPU. `Compact` fills one socket before using the next, keeping threads close together; `Scatter` deals threads out across the sockets in turn, making use of every socket's memory bandwidth. `Unpinned` leaves placement to the operating system. Only applies when threads are not shared between sessions.
 
 ---
 
 * `FPS`: Frames-Per-Second, or how fastthe playback is. If this is faster than the model, then stuttering will occur.
+* `Steps per Frame`: Number of simulation steps taken between rendered frames.
 * `Display Quadtree`: Render the quadtree subdivisions.
 * `Play`: Play the simulation with the current configuration, or unpause the simulation (turns to `Stop`).
 * `Stop`: Pause the currently running simulation (turns to `Play`).
@@ -241,16 +339,28 @@ app = pn.template.BootstrapTemplate(
             num_particles_slider,
             bounds_slider,
             time_delta_slider,
+            softening_slider,
         ),
         pn.WidgetBox(
             pn.panel('Performance Options'),
             seed_input,
             theta_slider,
-            thread_count_slider
+            leaf_size_slider,
+            group_size_slider,
+            refit_slider,
+            quadrupole_toggle,
+            single_precision_toggle,
+            engine_select,
+            expansion_order_slider,
+            mesh_size_slider,
+            thread_count_slider,
+            shared_pool_toggle,
+            affinity_select
         ),
         pn.WidgetBox(
             pn.panel('Playback Options'),
             fps_slider,
+            steps_per_frame_slider,
             pn.Row(quadtree_display, width=321),
             pn.Row(play_button, reset_button, width=321)
         )
@@ -0,0 +1,192 @@
+#pragma once
+
+#include <algorithm>
+#include <cctype>
+#include <cstddef>
+#include <fstream>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#ifdef __linux__
+#include <pthread.h>
+#include <sched.h>
+#endif
+
+/**
+ * Returns the CPUs the process is allowed to run on, in ascending order. Where thread affinity
+ * is not supported the list is empty.
+ */
+inline std::vector<int> available_cpus()
+{
+    std::vector<int> cpus;
+#ifdef __linux__
+    cpu_set_t set;
+    CPU_ZERO(&set);
+    if (sched_getaffinity(0, sizeof(set), &set) == 0)
+    {
+        for (int cpu = 0; cpu < CPU_SETSIZE; ++cpu)
+        {
+            if (CPU_ISSET(cpu, &set))
+            {
+                cpus.push_back(cpu);
+            }
+        }
+    }
+#endif
+    return cpus;
+}
+
+/**
+ * Returns the socket a CPU sits on, or 0 where the topology cannot be read.
+ */
+inline int cpu_package(const int cpu)
+{
+    std::ifstream file("/sys/devices/system/cpu/cpu" + std::to_string(cpu) + "/topology/physical_package_id");
+    int package = 0;
+    file >> package;
+    return file ? package : 0;
+}
+
+/**
+ * Parses a comma-separated list of CPUs and CPU ranges, such as "0,2,4-7".
+ */
+inline std::vector<int> parse_cpu_list(const std::string &list)
+{
+    std::vector<int> cpus;
+    std::size_t start = 0;
+    while (start <= list.size())
+    {
+        auto end = std::min(list.find(',', start), list.size());
+        auto item = list.substr(start, end - start);
+        auto dash = item.find('-');
+        try
+        {
+            std::size_t used = 0;
+            auto first = std::stoi(item, &used);
+            auto last = first;
+            if (dash != std::string::npos && used == dash)
+            {
+                auto rest = item.substr(dash + 1);
+                last = std::stoi(rest, &used);
+                used += dash + 1;
+            }
+            if (used != item.size() || first < 0 || last < first)
+            {
+                throw std::invalid_argument(item);
+            }
+            for (auto cpu = first; cpu <= last; ++cpu)
+            {
+                cpus.push_back(cpu);
+            }
+        }
+        catch (const std::logic_error &)
+        {
+            throw std::invalid_argument("invalid CPU list entry '" + item + "' in affinity '" + list + "'");
+        }
+        start = end + 1;
+    }
+    return cpus;
+}
+
+/**
+ * Resolves an affinity setting into the CPU each worker is pinned to; an empty result leaves
+ * the workers unpinned. Workers past the end of the resolved list wrap around to its start.
+ *
+ *     "none":    no pinning
+ *     "compact": fill one socket's CPUs before moving on to the next, keeping workers close
+ *     "scatter": deal the workers out across the sockets in turn, spreading memory bandwidth
+ *     a list:    the CPUs named by a list such as "0,2,4-7", in that order
+ *
+ * Arguments:
+ *     name: affinity setting
+ *     num_threads: number of workers to place
+ */
+inline std::vector<int> affinity_from_name(const std::string &name, const std::size_t num_threads)
+{
+    if (name == "none")
+    {
+        return {};
+    }
+    auto available = available_cpus();
+    std::vector<int> cpus;
+    if (name == "compact" || name == "scatter")
+    {
+        std::vector<std::vector<int>> sockets;
+        for (auto cpu : available)
+        {
+            auto package = static_cast<std::size_t>(cpu_package(cpu));
+            sockets.resize(std::max(sockets.size(), package + 1));
+            sockets[package].push_back(cpu);
+        }
+        std::size_t deepest = 0;
+        for (const auto &socket : sockets)
+        {
+            deepest = std::max(deepest, socket.size());
+        }
+        if (name == "compact")
+        {
+            for (const auto &socket : sockets)
+            {
+                cpus.insert(cpus.end(), socket.begin(), socket.end());
+            }
+        }
+        else
+        {
+            for (std::size_t rank = 0; rank < deepest; ++rank)
+            {
+                for (const auto &socket : sockets)
+                {
+                    if (rank < socket.size())
+                    {
+                        cpus.push_back(socket[rank]);
+                    }
+                }
+            }
+        }
+    }
+    else if (!name.empty() && std::isdigit(static_cast<unsigned char>(name[0])))
+    {
+        cpus = parse_cpu_list(name);
+        for (auto cpu : cpus)
+        {
+            if (!available.empty() && !std::binary_search(available.begin(), available.end(), cpu))
+            {
+                throw std::invalid_argument("CPU " + std::to_string(cpu) + " in affinity '" + name + "' is not available to this process");
+            }
+        }
+    }
+    else
+    {
+        throw std::invalid_argument("unknown affinity '" + name + "'; expected 'none', 'compact', 'scatter' or a CPU list such as '0,2,4-7'");
+    }
+    if (cpus.empty())
+    {
+        return {};
+    }
+    std::vector<int> assigned(num_threads);
+    for (std::size_t i = 0; i < num_threads; ++i)
+    {
+        assigned[i] = cpus[i % cpus.size()];
+    }
+    return assigned;
+}
+
+/**
+ * Pins the calling thread to a single CPU. Does nothing where thread affinity is not supported.
+ */
+inline void pin_current_thread(const int cpu)
+{
+#ifdef __linux__
+    if (cpu < 0 || cpu >= CPU_SETSIZE)
+    {
+        return;
+    }
+    cpu_set_t set;
+    CPU_ZERO(&set);
+    CPU_SET(cpu, &set);
+    pthread_setaffinity_np(pthread_self(), sizeof(set), &set);
+#else
+    (void)cpu;
+#endif
+}
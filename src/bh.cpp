@@ -1,61 +1,695 @@
+#include <algorithm>
+#include <exception>
+#include <memory>
+#include <mutex>
+#include <stdexcept>
+#include <string>
+#include <thread>
+#include <type_traits>
+#include <utility>
+#include <vector>
+
+#include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
 namespace py = pybind11;
 
 #include "particle_system.h"
+#include "shared_pool.h"
 #include "syncable.h"
 
 
+/**
+ * Optional settings of a MultithreadedParticleSystem, named as the keyword arguments the Python
+ * constructor accepts them by.
+ */
+struct SystemOptions {
+    std::string kernel = "fast";        // gravity kernel; see kernel_from_name
+    double softening = 0.0;             // Plummer softening length
+    std::size_t leaf_size = 8;          // most particles a tree cell may hold before it is split
+    std::string engine = "barnes_hut";  // force engine; see engine_from_name
+    int expansion_order = 4;            // order of the Fast Multipole expansions
+    bool quadrupole = false;            // add cells' quadrupoles to the Barnes-Hut far field
+    std::size_t mesh_size = 256;        // cells per side of the particle mesh
+    double refit = 0.0;                 // refit threshold; 0 rebuilds the tree every step
+    std::size_t group_size = 32;        // most particles that share a tree walk; 0 walks each on its own
+    std::string precision = "double";   // precision of the interaction sums; see precision_from_name
+    std::string affinity = "none";      // placement of the pool's threads; see affinity_from_name
+    bool shared_pool = false;           // run on the process-wide SharedPool instead of an own pool
+};
+
+/**
+ * Fills SystemOptions from the keyword arguments of the Python constructor, leaving the defaults
+ * of any that were not given.
+ *
+ * Arguments:
+ *     kwargs: the keyword arguments; each must name a field of SystemOptions
+ */
+SystemOptions options_from_kwargs(const py::kwargs &kwargs)
+{
+    SystemOptions options;
+    std::vector<std::string> known;
+    auto read = [&](const char *name, auto &field)
+    {
+        known.emplace_back(name);
+        if (!kwargs.contains(name))
+        {
+            return;
+        }
+        try
+        {
+            field = kwargs[name].cast<std::decay_t<decltype(field)>>();
+        }
+        catch (const py::cast_error &)
+        {
+            throw py::type_error(std::string("invalid type for keyword argument '") + name + "'");
+        }
+    };
+    read("kernel", options.kernel);
+    read("softening", options.softening);
+    read("leaf_size", options.leaf_size);
+    read("engine", options.engine);
+    read("expansion_order", options.expansion_order);
+    read("quadrupole", options.quadrupole);
+    read("mesh_size", options.mesh_size);
+    read("refit", options.refit);
+    read("group_size", options.group_size);
+    read("precision", options.precision);
+    read("affinity", options.affinity);
+    read("shared_pool", options.shared_pool);
+    for (const auto &[key, value] : kwargs)
+    {
+        auto name = key.cast<std::string>();
+        if (std::find(known.begin(), known.end(), name) == known.end())
+        {
+            throw py::type_error("unexpected keyword argument '" + name + "'");
+        }
+    }
+    return options;
+}
+
+
 struct MultithreadedParticleSystem : ParticleSystem {
-    MultithreadedParticleSystem(const int num_particles, const double bounds, const int seed, const double theta, const double dt, const std::size_t num_threads):
+    MultithreadedParticleSystem(const int num_particles, const double bounds, const int seed, const double theta, const double dt, const std::size_t num_threads, const SystemOptions &options = {}):
         ParticleSystem(num_particles, bounds, theta, seed),
-        delta_time(dt),
-        pool(num_threads)
+        delta_time(dt)
     {
-        auto slice_size = num_particles / num_threads;
-        for (int i = 0; i < num_threads; ++i)
+        if (!(dt > 0.0))
+        {
+            throw std::invalid_argument("dt must be positive");
+        }
+        kernel = kernel_from_name(options.kernel);
+        engine = engine_from_name(options.engine, particles.size());
+        fmm = FastMultipole(options.expansion_order);
+        // TreePM splits the force at 1.25 cells, and the tree walk stops at 4.5 times that
+        mesh = ParticleMesh(options.mesh_size, engine == Engine::treepm ? 1.25 : 0.0);
+        set_softening(options.softening);
+        qt.leaf_capacity = std::max<std::size_t>(options.leaf_size, 1);
+        qt.use_quadrupole = options.quadrupole;
+        refit_threshold = options.refit;
+        group_size = options.group_size;
+        qt.precision = precision_from_name(options.precision);
+        if (options.shared_pool && options.affinity != "none")
+        {
+            throw std::invalid_argument("affinity only applies to a system's own pool, not the shared pool");
+        }
+        if (kernel == Kernel::trig && engine != Engine::barnes_hut && engine != Engine::direct)
+        {
+            throw std::invalid_argument("the trig kernel only applies to the Barnes-Hut and direct engines");
+        }
+        if (options.quadrupole && engine != Engine::barnes_hut)
+        {
+            // TreePM would also count the long-range part of each quadrupole twice, once more on the mesh
+            throw std::invalid_argument("quadrupole moments only apply to the Barnes-Hut engine");
+        }
+        auto grouped = engine == Engine::barnes_hut && group_size > 0;
+        if (qt.precision == Precision::single && (kernel != Kernel::fast || !(grouped || engine == Engine::direct)))
+        {
+            throw std::invalid_argument("single precision only applies to the fast kernel, with the direct engine or Barnes-Hut group walks (group_size > 0)");
+        }
+        affinity_policy = options.affinity;
+        shared = options.shared_pool;
+        start_pool(num_threads);
+        place_particles(workers);
+
+        handles.reserve(particles.size());
+        for (std::size_t i = 0; i < particles.size(); ++i)
         {
-            callables.emplace_back(
-                std::bind(
-                    &ParticleSystem::collect_forces,
-                    std::ref(*this),
-                    i * slice_size,
-                    slice_size
-                )
-            );
+            handles.push_back({&particles, i});
         }
-        pool.initialize(callables);
+    }
+
+    /**
+     * Replaces the thread pool with one of a number of threads, pinned by the affinity policy the
+     * system was created with; on the shared pool, sets how many of its threads the system may
+     * occupy at once instead. Work is shared out by the worker count on every step, so nothing
+     * else depends on it. The particles stay where they are, since arrays handed to Python may
+     * still view them.
+     *
+     * Arguments:
+     *     num_threads: number of worker threads; at least one
+     */
+    void set_num_threads(const std::size_t num_threads)
+    {
+        std::lock_guard<std::mutex> guard(step_mutex);
+        start_pool(num_threads);
+    }
+
+    /**
+     * Sets the Plummer softening length, which every engine but the particle mesh applies; the
+     * mesh is already smoothed over its cells.
+     *
+     * Arguments:
+     *     length: softening length; must be 0 with the particle-mesh engine
+     */
+    void set_softening(const double length)
+    {
+        if (length != 0.0 && engine == Engine::pm)
+        {
+            throw std::invalid_argument("softening does not apply to the particle-mesh engine");
+        }
+        softening = length;
     }
 
     void update() {
-        build_tree();
-        pool.trigger();
-        integrate(delta_time);
+        advance(1);
+    }
+
+    /**
+     * Advances the simulation by a number of steps without returning to the caller in between,
+     * optionally recording the particle positions along the way.
+     *
+     * Arguments:
+     *     n_steps: number of steps to take
+     *     snapshot_stride: record the positions after every this many steps; 0 records nothing
+     *
+     * Returns:
+     *     recorded positions, one (2, N) block of x-values then y-values per snapshot
+     */
+    std::vector<double> advance(const std::size_t n_steps, const std::size_t snapshot_stride = 0)
+    {
+        std::lock_guard<std::mutex> guard(step_mutex);
+        std::vector<double> snapshots;
+        if (snapshot_stride)
+        {
+            snapshots.reserve(2 * particles.size() * (n_steps / snapshot_stride));
+        }
+        for (std::size_t i = 1; i <= n_steps; ++i)
+        {
+            step();
+            if (snapshot_stride && i % snapshot_stride == 0)
+            {
+                record_positions(snapshots);
+            }
+        }
+        return snapshots;
+    }
+
+    /**
+     * Advances the simulation until it reaches the given simulation time, optionally recording
+     * the particle positions along the way.
+     *
+     * Arguments:
+     *     end_time: simulation time to stop at; no step is taken if it has already been reached
+     *     snapshot_stride: record the positions after every this many steps; 0 records nothing
+     *
+     * Returns:
+     *     recorded positions, one (2, N) block of x-values then y-values per snapshot
+     */
+    std::vector<double> run_until(const double end_time, const std::size_t snapshot_stride = 0)
+    {
+        std::lock_guard<std::mutex> guard(step_mutex);
+        std::vector<double> snapshots;
+        // compare against half a step so that accumulated rounding neither adds nor drops a step
+        for (std::size_t i = 1; simulation_time + 0.5 * delta_time < end_time; ++i)
+        {
+            step();
+            if (snapshot_stride && i % snapshot_stride == 0)
+            {
+                record_positions(snapshots);
+            }
+        }
+        return snapshots;
+    }
+
+    /**
+     * Takes a single step; the caller is expected to hold the step mutex. The Barnes-Hut walks
+     * integrate each chunk of particles as soon as its forces are done; the other engines still
+     * need every position while they collect forces, so they integrate in a pass of their own.
+     */
+    void step()
+    {
+        if (engine == Engine::direct)
+        {
+            workers.run_chunked(particles.size(), 64, [this](std::size_t begin, std::size_t end, std::size_t)
+            {
+                collect_direct_forces(begin, end - begin);
+            });
+        }
+        else if (engine == Engine::pm)
+        {
+            mesh.evaluate(particles, ll, ur, workers);
+        }
+        else if (engine == Engine::treepm)
+        {
+            build_tree(workers);
+            auto rs = mesh.split * mesh.cell_width(ll, ur);
+            if (rs > 0.0)
+            {
+                ShortRangeKernel k {softening * softening, rs, 4.5 * rs};
+                if (group_size)
+                {
+                    workers.run_chunked(qt.groups.size(), 1, [this, &k](std::size_t begin, std::size_t end, std::size_t w)
+                    {
+                        collect_group_forces(k, begin, end - begin, lists[w]);
+                    });
+                }
+                else
+                {
+                    workers.run_chunked(particles.size(), 32, [this, &k](std::size_t begin, std::size_t end, std::size_t)
+                    {
+                        collect_forces(k, begin, end - begin);
+                    });
+                }
+                mesh.evaluate(particles, ll, ur, workers);
+            }
+            // with the bounds collapsed to a point there is no mesh to split the force with, so
+            // the tree carries all of it
+            else if (group_size)
+            {
+                workers.run_chunked(qt.groups.size(), 1, [this](std::size_t begin, std::size_t end, std::size_t w)
+                {
+                    collect_group_forces(begin, end - begin, lists[w]);
+                });
+            }
+            else
+            {
+                workers.run_chunked(particles.size(), 32, [this](std::size_t begin, std::size_t end, std::size_t)
+                {
+                    collect_forces(begin, end - begin);
+                });
+            }
+        }
+        else if (engine == Engine::fmm)
+        {
+            build_tree(workers);
+            fmm.evaluate(qt, particles, softening, workers);
+        }
+        else if (group_size)
+        {
+            build_tree(workers);
+            partial_bounds.assign(workers.count, 0.0);
+            workers.run_chunked(qt.groups.size(), 1, [this](std::size_t begin, std::size_t end, std::size_t w)
+            {
+                collect_group_forces(begin, end - begin, lists[w]);
+                for (auto g = begin; g < end; ++g)
+                {
+                    const auto &group = qt.nodes[qt.groups[g]];
+                    partial_bounds[w] = std::max(partial_bounds[w], integrate_sorted(group.first, group.count, delta_time));
+                }
+            });
+            reduce_bounds();
+        }
+        else
+        {
+            build_tree(workers);
+            partial_bounds.assign(workers.count, 0.0);
+            workers.run_chunked(particles.size(), 32, [this](std::size_t begin, std::size_t end, std::size_t w)
+            {
+                collect_forces(begin, end - begin);
+                partial_bounds[w] = std::max(partial_bounds[w], integrate_sorted(begin, end - begin, delta_time));
+            });
+            reduce_bounds();
+        }
+        if (engine != Engine::barnes_hut)
+        {
+            integrate(delta_time, workers);
+        }
         simulation_time += delta_time;
     }
 
+    /**
+     * Starts a pool of worker threads, first stopping the current one, and points the workers
+     * handle at it. A system on the shared pool submits its tasks there instead, as one job per
+     * worker.
+     */
+    void start_pool(const std::size_t num_threads)
+    {
+        if (num_threads == 0)
+        {
+            throw std::invalid_argument("num_threads must be at least 1");
+        }
+        if (shared)
+        {
+            workers = {
+                .count = num_threads,
+                .dispatch = [this](const Workers::Task &t) { SharedPool::instance().run(t, workers.count); }
+            };
+            lists.resize(num_threads);
+            return;
+        }
+        // resolve the placement before stopping the current pool, so a bad policy leaves it running
+        auto cpus = affinity_from_name(affinity_policy, num_threads);
+        pool.reset();
+        callables.clear();
+        for (std::size_t i = 0; i < num_threads; ++i)
+        {
+            callables.emplace_back([this, i]() { task(i); });
+        }
+        pool = std::make_unique<Syncable>(num_threads);
+        pool->initialize(callables, cpus);
+        workers = {
+            .count = num_threads,
+            .dispatch = [this](const Workers::Task &t)
+            {
+                task = t;
+                pool->trigger();
+            }
+        };
+        lists.resize(num_threads);
+    }
+
+    /**
+     * Appends the current x-positions followed by the current y-positions to a buffer.
+     */
+    void record_positions(std::vector<double> &snapshots) const
+    {
+        // the y-run directly follows the x-run, so both are copied in one go
+        snapshots.insert(snapshots.end(), particles.x(), particles.x() + 2 * particles.size());
+    }
+
     std::vector<std::function<void(void)>> callables;
+    Workers::Task task;  // the task the pool runs on its next trigger
+    Workers workers;     // dispatches tasks onto the pool
     double simulation_time = 0.0;
     double delta_time = 1.0;
 
-    Syncable pool;
+    /**
+     * Overwrites fields of every particle from contiguous buffers of values, all under a single
+     * hold of the step mutex so no step sees only some of them. Writing either position refits
+     * the bounds of the next tree to the new positions.
+     *
+     * Arguments:
+     *     fields: each field to write, with one value per particle in particle order
+     */
+    void set_fields(const std::vector<std::pair<Field, const double *>> &fields)
+    {
+        std::lock_guard<std::mutex> guard(step_mutex);
+        bool moved = false;
+        for (const auto &[field, values] : fields)
+        {
+            std::copy(values, values + particles.size(), particles.field(field));
+            moved = moved || field == Field::x || field == Field::y;
+        }
+        if (moved)
+        {
+            fit_bounds();
+        }
+    }
+
+    std::vector<Particle> handles;  // Python-facing proxies, one per particle
+
+    std::mutex step_mutex;  // serializes steps issued from Python and from step_async
+
+    std::string affinity_policy;     // affinity the pool's threads are placed by
+    bool shared = false;             // whether tasks go to the process-wide SharedPool instead of pool
+    std::unique_ptr<Syncable> pool;  // worker threads; replaced by set_num_threads
 };
 
+/**
+ * Creates a NumPy array that aliases particle storage owned by the model; the model is set as the
+ * base of the array so the storage outlives every view handed out to Python.
+ *
+ * Arguments:
+ *     self: the Python-side model object that owns the storage
+ *     field: the first field to view
+ *     rows: number of adjacent fields to view, one per row of the array
+ */
+py::array particle_view(py::object self, const Field field, const py::ssize_t rows)
+{
+    auto &system = self.cast<MultithreadedParticleSystem&>();
+    auto count = static_cast<py::ssize_t>(system.particles.size());
+    auto data = system.particles.field(field);
+    if (rows == 1)
+    {
+        return py::array_t<double>({count}, data, self);
+    }
+    return py::array_t<double>({rows, count}, data, self);
+}
+
+using InputArray = py::array_t<double, py::array::c_style | py::array::forcecast>;
+
+/**
+ * Validates that an array holds exactly one value per particle of the model.
+ *
+ * Arguments:
+ *     system: the model the values are destined for
+ *     values: one-dimensional array with one value per particle
+ *     name: argument name used when reporting a bad shape
+ *
+ * Returns:
+ *     pointer to the contiguous values
+ */
+const double *checked_data(const MultithreadedParticleSystem &system, const InputArray &values, const char *name)
+{
+    if (values.ndim() != 1 || static_cast<std::size_t>(values.shape(0)) != system.particles.size())
+    {
+        throw std::invalid_argument(
+            std::string(name) + " must be a one-dimensional array of " + std::to_string(system.particles.size()) + " values"
+        );
+    }
+    return values.data();
+}
+
+/**
+ * Locks a model's step mutex, so that state a step reads or writes can be accessed safely from
+ * Python. A step may be running in the background, so the GIL is not held while waiting on it.
+ *
+ * Arguments:
+ *     system: the model to lock
+ *
+ * Returns:
+ *     the held lock
+ */
+std::unique_lock<std::mutex> lock_steps(MultithreadedParticleSystem &system)
+{
+    std::unique_lock<std::mutex> guard(system.step_mutex, std::defer_lock);
+    {
+        py::gil_scoped_release release;
+        guard.lock();
+    }
+    return guard;
+}
+
+/**
+ * Reads a member of a model under its step mutex; see lock_steps.
+ */
+template <auto Member>
+auto locked_get(MultithreadedParticleSystem &system)
+{
+    auto guard = lock_steps(system);
+    return system.*Member;
+}
+
+/**
+ * Writes a member of a model under its step mutex; see lock_steps.
+ */
+template <auto Member>
+void locked_set(MultithreadedParticleSystem &system, const std::remove_reference_t<decltype(system.*Member)> &value)
+{
+    auto guard = lock_steps(system);
+    system.*Member = value;
+}
+
+/**
+ * Returns the leaf extents of the current quadtree as a read-only (N, 4) array of
+ * (x0, y0, x1, y1) rows. The extents are filled once per tree and shared by every call until
+ * the next step.
+ *
+ * Arguments:
+ *     system: the model to query
+ */
+py::array get_extents_array(MultithreadedParticleSystem &system)
+{
+    auto guard = lock_steps(system);
+    auto buffer = system.get_extents_buffer();
+    auto rows = static_cast<py::ssize_t>(buffer->size() / 4);
+    // the capsule shares ownership of the buffer, so the array stays valid across later steps
+    auto owner = new std::shared_ptr<std::vector<double>>(buffer);
+    py::capsule base(owner, [](void *p) { delete static_cast<std::shared_ptr<std::vector<double>>*>(p); });
+    py::array_t<double> extents({rows, py::ssize_t{4}}, buffer->data(), base);
+    extents.attr("setflags")(py::arg("write") = false);
+    return extents;
+}
+
+/**
+ * Hands recorded position snapshots to NumPy without copying them.
+ *
+ * Arguments:
+ *     system: the model the snapshots were recorded from
+ *     snapshots: consecutive (2, N) blocks of positions
+ *
+ * Returns:
+ *     (k, 2, N) array of snapshots, or None if none were requested
+ */
+py::object snapshots_array(const MultithreadedParticleSystem &system, std::vector<double> &&snapshots, const std::size_t snapshot_stride)
+{
+    if (!snapshot_stride)
+    {
+        return py::none();
+    }
+    auto count = static_cast<py::ssize_t>(system.particles.size());
+    auto owner = new std::vector<double>(std::move(snapshots));
+    py::capsule base(owner, [](void *p) { delete static_cast<std::vector<double>*>(p); });
+    auto frames = count ? static_cast<py::ssize_t>(owner->size()) / (2 * count) : 0;
+    return py::array_t<double>({frames, py::ssize_t{2}, count}, owner->data(), base);
+}
+
+/**
+ * Runs a number of steps in the background, without the GIL, and returns a
+ * concurrent.futures.Future that is resolved once the steps complete. Wrap it with
+ * asyncio.wrap_future to await it from an event loop. A system on the shared pool is stepped
+ * by one of the pool's own threads, so any number of them adds no threads; any other system
+ * gets a thread of its own for the steps, next to the threads of its pool.
+ *
+ * Arguments:
+ *     self: the Python-side model object to step; kept alive until the steps complete
+ *     n_steps: number of steps to take
+ */
+py::object step_async(py::object self, const std::size_t n_steps)
+{
+    auto &system = self.cast<MultithreadedParticleSystem&>();
+    auto future = py::module_::import("concurrent.futures").attr("Future")();
+    future.attr("set_running_or_notify_cancel")();
+    auto steps = [&system, self, future, n_steps]() mutable
+    {
+        std::string error;
+        try
+        {
+            system.advance(n_steps);
+        }
+        catch (const std::exception &e)
+        {
+            error = e.what();
+            if (error.empty())
+            {
+                error = "step failed";
+            }
+        }
+        // detach the references before waiting on the GIL; if the interpreter is shutting
+        // down the acquire never returns and nothing must be released without the GIL
+        auto future_handle = future.release();
+        auto self_handle = self.release();
+        py::gil_scoped_acquire gil;
+        auto result = py::reinterpret_steal<py::object>(future_handle);
+        auto keep_alive = py::reinterpret_steal<py::object>(self_handle);
+        if (error.empty())
+        {
+            result.attr("set_result")(py::none());
+        }
+        else
+        {
+            result.attr("set_exception")(py::module_::import("builtins").attr("RuntimeError")(error));
+        }
+    };
+    if (system.shared)
+    {
+        SharedPool::instance().submit(std::move(steps));
+    }
+    else
+    {
+        std::thread(std::move(steps)).detach();
+    }
+    return future;
+}
+
 PYBIND11_MODULE(ParticleModel, m) {
+    m.attr("direct_crossover") = direct_crossover;
+
     py::class_<MultithreadedParticleSystem>(m, "MultithreadedParticleSystem")
-        .def(py::init<const int, const double, const int, const double, const double, const std::size_t>())
-        .def("update", &MultithreadedParticleSystem::update)
-        .def("get_extents", &MultithreadedParticleSystem::get_extents)
-        .def_readwrite("ll", &MultithreadedParticleSystem::ll)
-        .def_readwrite("ur", &MultithreadedParticleSystem::ur)
-        .def_readwrite("simulation_time", &MultithreadedParticleSystem::simulation_time)
-        .def_readwrite("particles", &MultithreadedParticleSystem::particles);
+        .def(
+            py::init([](const int num_particles, const double bounds, const int seed, const double theta, const double dt, const std::size_t num_threads, const py::kwargs &kwargs)
+            {
+                return std::make_unique<MultithreadedParticleSystem>(num_particles, bounds, seed, theta, dt, num_threads, options_from_kwargs(kwargs));
+            }),
+            py::arg("num_particles"), py::arg("bounds"), py::arg("seed"), py::arg("theta"), py::arg("dt"), py::arg("num_threads")
+        )
+        .def("set_num_threads", &MultithreadedParticleSystem::set_num_threads, py::arg("num_threads"), py::call_guard<py::gil_scoped_release>())
+        .def_property_readonly("num_threads", [](const MultithreadedParticleSystem &self) { return self.workers.count; })
+        .def("update", [](MultithreadedParticleSystem &self, const std::size_t n_steps, const std::size_t snapshot_stride)
+            {
+                std::vector<double> snapshots;
+                {
+                    py::gil_scoped_release release;
+                    snapshots = self.advance(n_steps, snapshot_stride);
+                }
+                return snapshots_array(self, std::move(snapshots), snapshot_stride);
+            }, py::arg("n_steps") = 1, py::arg("snapshot_stride") = 0)
+        .def("run_until", [](MultithreadedParticleSystem &self, const double simulation_time, const std::size_t snapshot_stride)
+            {
+                std::vector<double> snapshots;
+                {
+                    py::gil_scoped_release release;
+                    snapshots = self.run_until(simulation_time, snapshot_stride);
+                }
+                return snapshots_array(self, std::move(snapshots), snapshot_stride);
+            }, py::arg("simulation_time"), py::arg("snapshot_stride") = 0)
+        .def("step_async", &step_async, py::arg("n_steps") = 1)
+        .def("set_positions", [](MultithreadedParticleSystem &self, InputArray x, InputArray y)
+            {
+                auto x_data = checked_data(self, x, "x");
+                auto y_data = checked_data(self, y, "y");
+                // a step may be running in the background; do not hold the GIL while waiting on it
+                py::gil_scoped_release release;
+                self.set_fields({{Field::x, x_data}, {Field::y, y_data}});
+            }, py::arg("x"), py::arg("y"))
+        .def("set_velocities", [](MultithreadedParticleSystem &self, InputArray vx, InputArray vy)
+            {
+                auto vx_data = checked_data(self, vx, "vx");
+                auto vy_data = checked_data(self, vy, "vy");
+                py::gil_scoped_release release;
+                self.set_fields({{Field::vx, vx_data}, {Field::vy, vy_data}});
+            }, py::arg("vx"), py::arg("vy"))
+        .def("set_masses", [](MultithreadedParticleSystem &self, InputArray m)
+            {
+                auto m_data = checked_data(self, m, "m");
+                py::gil_scoped_release release;
+                self.set_fields({{Field::m, m_data}});
+            }, py::arg("m"))
+        .def("set_state", [](MultithreadedParticleSystem &self, InputArray x, InputArray y, InputArray vx, InputArray vy, InputArray m)
+            {
+                auto x_data = checked_data(self, x, "x");
+                auto y_data = checked_data(self, y, "y");
+                auto vx_data = checked_data(self, vx, "vx");
+                auto vy_data = checked_data(self, vy, "vy");
+                auto m_data = checked_data(self, m, "m");
+                py::gil_scoped_release release;
+                self.set_fields({{Field::x, x_data}, {Field::y, y_data}, {Field::vx, vx_data}, {Field::vy, vy_data}, {Field::m, m_data}});
+            }, py::arg("x"), py::arg("y"), py::arg("vx"), py::arg("vy"), py::arg("m"))
+        .def("get_extents", [](MultithreadedParticleSystem &self)
+            {
+                auto guard = lock_steps(self);
+                return self.get_extents();
+            })
+        .def("get_extents_array", &get_extents_array)
+        .def_property("ll", &locked_get<&MultithreadedParticleSystem::ll>, &locked_set<&MultithreadedParticleSystem::ll>)
+        .def_property("ur", &locked_get<&MultithreadedParticleSystem::ur>, &locked_set<&MultithreadedParticleSystem::ur>)
+        .def_property("simulation_time", &locked_get<&MultithreadedParticleSystem::simulation_time>, &locked_set<&MultithreadedParticleSystem::simulation_time>)
+        .def_property("softening", &locked_get<&MultithreadedParticleSystem::softening>, [](MultithreadedParticleSystem &self, const double length)
+            {
+                auto guard = lock_steps(self);
+                self.set_softening(length);
+            })
+        .def_readonly("particles", &MultithreadedParticleSystem::handles)
+        .def_property_readonly("positions", [](py::object self) { return particle_view(self, Field::x, 2); })
+        .def_property_readonly("velocities", [](py::object self) { return particle_view(self, Field::vx, 2); })
+        .def_property_readonly("masses", [](py::object self) { return particle_view(self, Field::m, 1); });
 
     py::class_<Particle>(m, "Particle")
-        .def_readwrite("x", &Particle::x)
-        .def_readwrite("y", &Particle::y)
-        .def_readwrite("vx", &Particle::vx)
-        .def_readwrite("vy", &Particle::vy)
-        .def_readwrite("m", &Particle::m);
+        .def_property("x", [](const Particle &p) { return p.get(Field::x); }, [](Particle &p, double v) { p.set(Field::x, v); })
+        .def_property("y", [](const Particle &p) { return p.get(Field::y); }, [](Particle &p, double v) { p.set(Field::y, v); })
+        .def_property("vx", [](const Particle &p) { return p.get(Field::vx); }, [](Particle &p, double v) { p.set(Field::vx, v); })
+        .def_property("vy", [](const Particle &p) { return p.get(Field::vy); }, [](Particle &p, double v) { p.set(Field::vy, v); })
+        .def_property("m", [](const Particle &p) { return p.get(Field::m); }, [](Particle &p, double v) { p.set(Field::m, v); });
 }
 
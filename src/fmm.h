@@ -0,0 +1,429 @@
+#pragma once
+
+#include <algorithm>
+#include <array>
+#include <atomic>
+#include <cmath>
+#include <cstddef>
+#include <cstdint>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include "parallel.h"
+#include "particle.h"
+#include "quadtree.h"
+
+/**
+ * Fast Multipole Method evaluated over a built QuadTree.
+ *
+ * The particles interact through the (softened) 1/r potential of the gravity kernels rather than
+ * the logarithmic potential of two-dimensional gravity, so the expansions are Cartesian Taylor
+ * series in the two in-plane coordinates instead of complex power series. Every cell is expanded
+ * about its centre of mass c, where the dipole term vanishes: its multipole expansion holds
+ * M(a,b) = sum m (c - x)^(a,b) / (a! b!) over its particles, and its local expansion the Taylor
+ * coefficients of the potential about c. Both are truncated at total degree order, and the
+ * derivatives of 1/r the translations need come from the McMurchie-Davidson recursion.
+ *
+ * Cells interact through a dual-tree walk: a pair of cells whose radii (the furthest any of their
+ * particles lies from their centres) add up to less than theta times their separation exchanges a
+ * single multipole-to-local translation, a pair of leaves interacts directly, and anything else is
+ * split, larger cell first.
+ */
+struct FastMultipole
+{
+    static constexpr int max_order = 12;
+
+    int order = 4;                       // truncation degree of the expansions
+    std::vector<double> multipoles;      // coefficients() multipole coefficients per node
+    std::vector<double> locals;          // coefficients() local coefficients per node
+    std::vector<std::array<double, 2>> centres;  // expansion centre of each node
+    std::vector<double> radii;           // furthest any particle of each node lies from its centre
+    std::vector<double> ax, ay;          // accelerations gathered in the tree's sorted order
+    std::vector<std::int32_t> cut;       // cells whose subtrees are handed out to workers
+    std::vector<char> is_cut;            // whether each node is one of the cut cells
+
+    FastMultipole(const int expansion_order = 4):
+        order(expansion_order)
+    {
+        if (order < 1 || order > max_order)
+        {
+            throw std::invalid_argument("expansion order must be between 1 and " + std::to_string(max_order));
+        }
+    }
+
+    std::size_t coefficients() const
+    {
+        return static_cast<std::size_t>((order + 1) * (order + 2) / 2);
+    }
+
+    /**
+     * Position of the coefficient of the (a, b) term, ordered by total degree.
+     */
+    static std::size_t index(const int a, const int b)
+    {
+        auto n = a + b;
+        return static_cast<std::size_t>(n * (n + 1) / 2 + b);
+    }
+
+    /**
+     * Fills powers[k] = v^k / k! for k up to n.
+     */
+    static void scaled_powers(const double v, const int n, double *powers)
+    {
+        powers[0] = 1.0;
+        for (int k = 1; k <= n; ++k)
+        {
+            powers[k] = powers[k - 1] * v / k;
+        }
+    }
+
+    /**
+     * Accumulates the acceleration of every particle in the tree into a store.
+     *
+     * Arguments:
+     *     qt: a tree built over the store
+     *     store: the particles to accumulate accelerations for
+     *     softening: Plummer softening length, applied to near and far interactions alike
+     *     workers: workers to share the passes between
+     */
+    void evaluate(const QuadTree &qt, ParticleStore &store, const double softening, const Workers &workers)
+    {
+        auto n = qt.order.size();
+        if (!n)
+        {
+            return;
+        }
+        auto eps2 = softening * softening;
+        auto ncoef = coefficients();
+        multipoles.assign(qt.nodes.size() * ncoef, 0.0);
+        locals.resize(qt.nodes.size() * ncoef);
+        centres.resize(qt.nodes.size());
+        radii.resize(qt.nodes.size());
+        ax.resize(n);
+        ay.resize(n);
+
+        // cut the tree into subtrees small enough to balance across the workers
+        auto grain = std::max<std::size_t>(qt.leaf_capacity, n / (8 * workers.count));
+        cut.clear();
+        is_cut.assign(qt.nodes.size(), 0);
+        _cut(qt, 0, grain);
+
+        // upward pass: every worker weighs whole subtrees, then the cells above them are weighed
+        std::atomic<std::size_t> next {0};
+        workers.run([&](std::size_t)
+        {
+            for (auto c = next++; c < cut.size(); c = next++)
+            {
+                _upward(qt, cut[c], false);
+            }
+        });
+        _upward(qt, 0, true);
+
+        // interactions and downward pass, one target subtree at a time
+        next = 0;
+        workers.run([&](std::size_t)
+        {
+            for (auto c = next++; c < cut.size(); c = next++)
+            {
+                const auto &node = qt.nodes[cut[c]];
+                std::fill(ax.begin() + node.first, ax.begin() + node.first + node.count, 0.0);
+                std::fill(ay.begin() + node.first, ay.begin() + node.first + node.count, 0.0);
+                _clear_locals(qt, cut[c]);
+                _interact(qt, cut[c], 0, eps2);
+                _downward(qt, cut[c]);
+                for (auto k = node.first; k < node.first + node.count; ++k)
+                {
+                    store.ax()[qt.order[k]] += ax[k];
+                    store.ay()[qt.order[k]] += ay[k];
+                }
+            }
+        });
+    }
+
+    void _cut(const QuadTree &qt, const std::int32_t n, const std::size_t grain)
+    {
+        const auto &node = qt.nodes[n];
+        if (node.is_leaf() || static_cast<std::size_t>(node.count) <= grain)
+        {
+            cut.push_back(n);
+            is_cut[n] = 1;
+            return;
+        }
+        for (auto c : node.children)
+        {
+            if (c >= 0)
+            {
+                _cut(qt, c, grain);
+            }
+        }
+    }
+
+    /**
+     * Forms the multipole expansions of a subtree: particle-to-multipole at the leaves, then
+     * multipole-to-multipole shifts up to the subtree's root. With top set, the walk stops at the
+     * cut cells, whose expansions have already been formed.
+     */
+    void _upward(const QuadTree &qt, const std::int32_t n, const bool top)
+    {
+        const auto &node = qt.nodes[n];
+        auto ncoef = coefficients();
+        auto M = &multipoles[n * ncoef];
+        // a massless cell has no centre of mass, so it is expanded about its middle instead
+        auto c = node.m > 0.0 ? node.center : std::array<double, 2> {node.ll[0] + 0.5 * node.width, node.ll[1] + 0.5 * node.width};
+        centres[n] = c;
+        // no particle lies further from the centre than the furthest corner of the cell
+        double reach_x = std::max(c[0] - node.ll[0], node.ll[0] + node.width - c[0]);
+        double reach_y = std::max(c[1] - node.ll[1], node.ll[1] + node.width - c[1]);
+        double radius = 0.0;
+        std::array<double, max_order + 1> px, py;
+        if (node.is_leaf())
+        {
+            for (auto k = node.first; k < node.first + node.count; ++k)
+            {
+                radius = std::max(radius, std::hypot(qt.sx[k] - c[0], qt.sy[k] - c[1]));
+                scaled_powers(c[0] - qt.sx[k], order, px.data());
+                scaled_powers(c[1] - qt.sy[k], order, py.data());
+                for (int a = 0; a <= order; ++a)
+                {
+                    for (int b = 0; a + b <= order; ++b)
+                    {
+                        M[index(a, b)] += qt.sm[k] * px[a] * py[b];
+                    }
+                }
+            }
+            radii[n] = radius;
+            return;
+        }
+        for (auto child : node.children)
+        {
+            if (child < 0)
+            {
+                continue;
+            }
+            if (!(top && is_cut[child]))
+            {
+                _upward(qt, child, top);
+            }
+            const auto &cc = centres[child];
+            radius = std::max(radius, std::hypot(c[0] - cc[0], c[1] - cc[1]) + radii[child]);
+            auto Mc = &multipoles[child * ncoef];
+            scaled_powers(c[0] - cc[0], order, px.data());
+            scaled_powers(c[1] - cc[1], order, py.data());
+            for (int a = 0; a <= order; ++a)
+            {
+                for (int b = 0; a + b <= order; ++b)
+                {
+                    double sum = 0.0;
+                    for (int i = 0; i <= a; ++i)
+                    {
+                        for (int j = 0; j <= b; ++j)
+                        {
+                            sum += px[a - i] * py[b - j] * Mc[index(i, j)];
+                        }
+                    }
+                    M[index(a, b)] += sum;
+                }
+            }
+        }
+        radii[n] = std::min(radius, std::hypot(reach_x, reach_y));
+    }
+
+    void _clear_locals(const QuadTree &qt, const std::int32_t n)
+    {
+        auto ncoef = coefficients();
+        std::fill(locals.begin() + n * ncoef, locals.begin() + (n + 1) * ncoef, 0.0);
+        for (auto c : qt.nodes[n].children)
+        {
+            if (c >= 0)
+            {
+                _clear_locals(qt, c);
+            }
+        }
+    }
+
+    /**
+     * Dual-tree walk accumulating the field of source cell s onto target cell t.
+     */
+    void _interact(const QuadTree &qt, const std::int32_t t, const std::int32_t s, const double eps2)
+    {
+        const auto &target = qt.nodes[t];
+        const auto &source = qt.nodes[s];
+        double dx = centres[t][0] - centres[s][0];
+        double dy = centres[t][1] - centres[s][1];
+        double reach = radii[t] + radii[s];
+        if (reach * reach < qt.theta * qt.theta * (dx * dx + dy * dy))
+        {
+            _m2l(s, t, dx, dy, eps2);
+        }
+        else if (target.is_leaf() && source.is_leaf())
+        {
+            _p2p(qt, target, source, t == s, eps2);
+        }
+        else if (source.is_leaf() || (!target.is_leaf() && target.width >= source.width))
+        {
+            for (auto c : target.children)
+            {
+                if (c >= 0)
+                {
+                    _interact(qt, c, s, eps2);
+                }
+            }
+        }
+        else
+        {
+            for (auto c : source.children)
+            {
+                if (c >= 0)
+                {
+                    _interact(qt, t, c, eps2);
+                }
+            }
+        }
+    }
+
+    void _p2p(const QuadTree &qt, const QuadNode &target, const QuadNode &source, const bool same, const double eps2)
+    {
+        FastKernel kernel {eps2};
+        auto first = source.first;
+        auto end = source.first + source.count;
+        for (auto k = target.first; k < target.first + target.count; ++k)
+        {
+            if (same)
+            {
+                kernel(qt.sx[k], qt.sy[k], &qt.sx[first], &qt.sy[first], &qt.sm[first], k - first, ax[k], ay[k]);
+                kernel(qt.sx[k], qt.sy[k], &qt.sx[k + 1], &qt.sy[k + 1], &qt.sm[k + 1], end - k - 1, ax[k], ay[k]);
+            }
+            else
+            {
+                kernel(qt.sx[k], qt.sy[k], &qt.sx[first], &qt.sy[first], &qt.sm[first], source.count, ax[k], ay[k]);
+            }
+        }
+    }
+
+    /**
+     * Translates the multipole expansion of cell s into the local expansion of cell t, whose
+     * centre sits at (dx, dy) from that of s.
+     */
+    void _m2l(const std::int32_t s, const std::int32_t t, const double dx, const double dy, const double eps2)
+    {
+        auto ncoef = coefficients();
+        const auto M = &multipoles[s * ncoef];
+        auto L = &locals[t * ncoef];
+
+        // R[m][index(u, v)] holds the m-th auxiliary of the (u, v) derivative of 1/r; the
+        // m = 0 entries are the derivatives themselves
+        std::array<std::array<double, (max_order + 1) * (max_order + 2) / 2>, max_order + 1> R;
+        double r2 = dx * dx + dy * dy + eps2;
+        double inv_r2 = 1.0 / r2;
+        R[0][0] = 1.0 / std::sqrt(r2);
+        for (int m = 1; m <= order; ++m)
+        {
+            R[m][0] = -(2 * m - 1) * inv_r2 * R[m - 1][0];
+        }
+        for (int degree = 1; degree <= order; ++degree)
+        {
+            for (int m = 0; m + degree <= order; ++m)
+            {
+                for (int u = 0; u <= degree; ++u)
+                {
+                    auto v = degree - u;
+                    double value;
+                    if (u > 0)
+                    {
+                        value = dx * R[m + 1][index(u - 1, v)];
+                        if (u > 1)
+                        {
+                            value += (u - 1) * R[m + 1][index(u - 2, v)];
+                        }
+                    }
+                    else
+                    {
+                        value = dy * R[m + 1][index(0, v - 1)];
+                        if (v > 1)
+                        {
+                            value += (v - 1) * R[m + 1][index(0, v - 2)];
+                        }
+                    }
+                    R[m][index(u, v)] = value;
+                }
+            }
+        }
+
+        for (int a = 0; a <= order; ++a)
+        {
+            for (int b = 0; a + b <= order; ++b)
+            {
+                double sum = 0.0;
+                for (int i = 0; a + b + i <= order; ++i)
+                {
+                    for (int j = 0; a + b + i + j <= order; ++j)
+                    {
+                        sum += R[0][index(a + i, b + j)] * M[index(i, j)];
+                    }
+                }
+                L[index(a, b)] += sum;
+            }
+        }
+    }
+
+    /**
+     * Shifts local expansions down a subtree and evaluates them at the particles of its leaves.
+     */
+    void _downward(const QuadTree &qt, const std::int32_t n)
+    {
+        const auto &node = qt.nodes[n];
+        auto ncoef = coefficients();
+        const auto L = &locals[n * ncoef];
+        const auto &c = centres[n];
+        std::array<double, max_order + 1> px, py;
+        if (node.is_leaf())
+        {
+            for (auto k = node.first; k < node.first + node.count; ++k)
+            {
+                scaled_powers(qt.sx[k] - c[0], order, px.data());
+                scaled_powers(qt.sy[k] - c[1], order, py.data());
+                double gx = 0.0;
+                double gy = 0.0;
+                for (int a = 0; a < order; ++a)
+                {
+                    for (int b = 0; a + b < order; ++b)
+                    {
+                        gx += L[index(a + 1, b)] * px[a] * py[b];
+                        gy += L[index(a, b + 1)] * px[a] * py[b];
+                    }
+                }
+                ax[k] += G * gx;
+                ay[k] += G * gy;
+            }
+            return;
+        }
+        for (auto child : node.children)
+        {
+            if (child < 0)
+            {
+                continue;
+            }
+            const auto &cc = centres[child];
+            auto Lc = &locals[child * ncoef];
+            scaled_powers(cc[0] - c[0], order, px.data());
+            scaled_powers(cc[1] - c[1], order, py.data());
+            for (int a = 0; a <= order; ++a)
+            {
+                for (int b = 0; a + b <= order; ++b)
+                {
+                    double sum = 0.0;
+                    for (int i = 0; a + b + i <= order; ++i)
+                    {
+                        for (int j = 0; a + b + i + j <= order; ++j)
+                        {
+                            sum += L[index(a + i, b + j)] * px[i] * py[j];
+                        }
+                    }
+                    Lc[index(a, b)] += sum;
+                }
+            }
+            _downward(qt, child);
+        }
+    }
+};
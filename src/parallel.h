@@ -0,0 +1,73 @@
+#pragma once
+
+#include <algorithm>
+#include <atomic>
+#include <cstddef>
+#include <functional>
+#include <utility>
+
+/**
+ * A handle to a set of workers that can run a task in lockstep. The task is invoked once per
+ * worker with that worker's index, and Workers::run returns once every invocation has finished.
+ * Without a dispatcher the invocations simply run one after another on the calling thread.
+ */
+struct Workers
+{
+    using Task = std::function<void(std::size_t)>;
+
+    std::size_t count {1};                     // number of workers
+    std::function<void(const Task&)> dispatch;  // runs a task on every worker and waits for them
+
+    void run(const Task &task) const
+    {
+        if (dispatch)
+        {
+            dispatch(task);
+        }
+        else
+        {
+            for (std::size_t w = 0; w < count; ++w)
+            {
+                task(w);
+            }
+        }
+    }
+
+    /**
+     * Returns the [begin, end) range of a worker's even share of n items.
+     *
+     * Arguments:
+     *     n: number of items to share out
+     *     worker: index of the worker
+     */
+    std::pair<std::size_t, std::size_t> slice(const std::size_t n, const std::size_t worker) const
+    {
+        return {n * worker / count, n * (worker + 1) / count};
+    }
+
+    /**
+     * Shares n items out in chunks that the workers pull from a common counter, so a worker whose
+     * chunks were cheap simply takes more of them instead of waiting on the others. The chunks are
+     * sized so each worker sees about chunks_per_worker of them, but never fewer than min_chunk
+     * items, and every item is handed out exactly once.
+     *
+     * Arguments:
+     *     n: number of items to share out
+     *     min_chunk: smallest number of items worth handing out at a time
+     *     body: called with the [begin, end) range of each chunk and the index of its worker
+     */
+    template <typename F>
+    void run_chunked(const std::size_t n, const std::size_t min_chunk, F &&body) const
+    {
+        constexpr std::size_t chunks_per_worker = 16;
+        auto chunk = std::max<std::size_t>({n / (chunks_per_worker * count), min_chunk, 1});
+        std::atomic<std::size_t> next {0};
+        run([&](std::size_t w)
+        {
+            for (auto begin = next.fetch_add(chunk); begin < n; begin = next.fetch_add(chunk))
+            {
+                body(begin, std::min(begin + chunk, n), w);
+            }
+        });
+    }
+};
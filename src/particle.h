@@ -1,48 +1,278 @@
 #pragma once
 
+#include <algorithm>
 #include <cmath>
+#include <cstddef>
 #include <iostream>
+#include <memory>
+#include <stdexcept>
+#include <string>
+#include <utility>
+#include <vector>
 
 constexpr double G = 6.67408e-11;
 
-struct Particle
+/**
+ * The per-particle fields held by a ParticleStore, in the order their runs are laid out.
+ */
+enum class Field : std::size_t
+{
+    x = 0,
+    y,
+    vx,
+    vy,
+    ax,
+    ay,
+    m
+};
+
+/**
+ * Allocator that leaves the values it default-constructs unset, so that allocating a buffer does
+ * not write to its pages. On a NUMA host each page is then placed on the node of the thread that
+ * first writes to it.
+ */
+template <typename T>
+struct UntouchedAllocator : std::allocator<T>
+{
+    UntouchedAllocator() = default;
+
+    template <typename U>
+    UntouchedAllocator(const UntouchedAllocator<U> &) {}
+
+    template <typename U>
+    void construct(U *p)
+    {
+        ::new (static_cast<void *>(p)) U;
+    }
+
+    template <typename U, typename... Args>
+    void construct(U *p, Args &&...args)
+    {
+        ::new (static_cast<void *>(p)) U(std::forward<Args>(args)...);
+    }
+};
+
+/**
+ * Structure-of-arrays storage for every particle in a system. Each field is a contiguous run of
+ * a single buffer; the x/y and vx/vy runs are adjacent so that positions and velocities can also
+ * be addressed as (2, N) blocks.
+ */
+struct ParticleStore
+{
+    ParticleStore(const std::size_t num_particles = 0, const double default_mass = 5.0e6):
+        count(num_particles),
+        data(num_fields * num_particles, 0.0)
+    {
+        std::fill(field(Field::m), field(Field::m) + count, default_mass);
+    }
+
+    std::size_t size() const
+    {
+        return count;
+    }
+
+    double *field(const Field f)
+    {
+        return data.data() + static_cast<std::size_t>(f) * count;
+    }
+
+    const double *field(const Field f) const
+    {
+        return data.data() + static_cast<std::size_t>(f) * count;
+    }
+
+    double *x() { return field(Field::x); }
+    double *y() { return field(Field::y); }
+    double *vx() { return field(Field::vx); }
+    double *vy() { return field(Field::vy); }
+    double *ax() { return field(Field::ax); }
+    double *ay() { return field(Field::ay); }
+    double *m() { return field(Field::m); }
+
+    const double *x() const { return field(Field::x); }
+    const double *y() const { return field(Field::y); }
+    const double *m() const { return field(Field::m); }
+
+    using Buffer = std::vector<double, UntouchedAllocator<double>>;
+    static constexpr std::size_t num_fields = static_cast<std::size_t>(Field::m) + 1;
+
+    std::size_t count {0};  // number of particles
+    Buffer data;            // every field, one run of count values after another
+};
+
+/**
+ * The gravity kernels a system can evaluate pairwise interactions with.
+ */
+enum class Kernel
+{
+    fast,  // a single reciprocal square root per interaction
+    trig   // resolves the direction with atan2, cos and sin; kept as a reference
+};
+
+inline Kernel kernel_from_name(const std::string &name)
 {
-    double x = 0.0;
-    double y = 0.0;
-    double vx = 0.0;
-    double vy = 0.0;
-    double ax = 0.0;
-    double ay = 0.0;
-    double m = 5.0e6;
+    if (name == "fast")
+    {
+        return Kernel::fast;
+    }
+    if (name == "trig")
+    {
+        return Kernel::trig;
+    }
+    throw std::invalid_argument("unknown kernel '" + name + "'; expected 'fast' or 'trig'");
+}
+
+/**
+ * The precisions interaction lists can be summed in. Positions, velocities and masses are always
+ * stored and integrated in double precision.
+ */
+enum class Precision
+{
+    full,   // every interaction in double precision
+    single  // interactions in single precision, relative to a nearby origin; sums in double
+};
+
+inline Precision precision_from_name(const std::string &name)
+{
+    if (name == "double")
+    {
+        return Precision::full;
+    }
+    if (name == "single")
+    {
+        return Precision::single;
+    }
+    throw std::invalid_argument("unknown precision '" + name + "'; expected 'double' or 'single'");
+}
 
-    void force(const Particle &o)
+/**
+ * Plummer-softened gravity evaluated as G * m * d / (|d|^2 + eps^2)^(3/2), using the offset itself
+ * as the direction so no trigonometry is needed.
+ */
+struct FastKernel
+{
+    double eps2 {0.0};  // squared softening length
+
+    /**
+     * Accumulates the acceleration exerted by a point mass onto an acceleration.
+     *
+     * Arguments:
+     *     dx, dy: offset from the particle to the point mass
+     *     omass: mass of the point mass
+     *     ax, ay: acceleration to accumulate into
+     */
+    void operator()(const double dx, const double dy, const double omass, double &ax, double &ay) const
     {
-        double dx = o.x - x;
-        double dy = o.y - y;
-        force(dx, dy, o.m);
+        double r2 = dx * dx + dy * dy + eps2;
+        double inv = 1.0 / std::sqrt(r2);
+        double f = G * omass * inv * inv * inv;
+        ax += f * dx;
+        ay += f * dy;
     }
 
-    void force(const double dx, const double dy, const double omass)
+    /**
+     * Accumulates the acceleration exerted by a contiguous block of point masses. The loop is a
+     * plain reduction over the block so that it vectorises.
+     *
+     * Arguments:
+     *     x, y: position of the particle
+     *     ox, oy, omass: positions and masses of the block
+     *     count: number of point masses in the block
+     *     ax, ay: acceleration to accumulate into
+     */
+    void operator()(const double x, const double y, const double *ox, const double *oy, const double *omass, const std::ptrdiff_t count, double &ax, double &ay) const
+    {
+        double sum_x = 0.0;
+        double sum_y = 0.0;
+        #pragma omp simd reduction(+:sum_x, sum_y)
+        for (std::ptrdiff_t j = 0; j < count; ++j)
+        {
+            double dx = ox[j] - x;
+            double dy = oy[j] - y;
+            double r2 = dx * dx + dy * dy + eps2;
+            double inv = 1.0 / std::sqrt(r2);
+            double f = G * omass[j] * inv * inv * inv;
+            sum_x += f * dx;
+            sum_y += f * dy;
+        }
+        ax += sum_x;
+        ay += sum_y;
+    }
+
+    /**
+     * As the block overload above, but over a block held in single precision. Each interaction
+     * is evaluated in single precision, at twice the vector width, and only the sums are kept in
+     * double; positions should be offsets from a nearby origin so that they keep their precision.
+     */
+    void operator()(const float x, const float y, const float *ox, const float *oy, const float *omass, const std::ptrdiff_t count, double &ax, double &ay) const
+    {
+        auto e2 = static_cast<float>(eps2);
+        double sum_x = 0.0;
+        double sum_y = 0.0;
+        #pragma omp simd reduction(+:sum_x, sum_y)
+        for (std::ptrdiff_t j = 0; j < count; ++j)
+        {
+            float dx = ox[j] - x;
+            float dy = oy[j] - y;
+            float r2 = dx * dx + dy * dy + e2;
+            float inv = 1.0f / std::sqrt(r2);
+            float f = omass[j] * inv * inv * inv;
+            sum_x += f * dx;
+            sum_y += f * dy;
+        }
+        ax += G * sum_x;
+        ay += G * sum_y;
+    }
+};
+
+/**
+ * The original kernel: the same softened magnitude, with the direction resolved through atan2,
+ * cos and sin.
+ */
+struct TrigKernel
+{
+    double eps2 {0.0};  // squared softening length
+
+    void operator()(const double dx, const double dy, const double omass, double &ax, double &ay) const
     {
         double d = std::hypot(dx, dy);
         double t = std::atan2(dy, dx);
-        double f = G * omass / (d * d);
+        double r2 = d * d + eps2;
+        double f = G * omass * d / (r2 * std::sqrt(r2));
         ax += f * std::cos(t);
         ay += f * std::sin(t);
     }
 
-    void integrate(const double dt)
+    void operator()(const double x, const double y, const double *ox, const double *oy, const double *omass, const std::ptrdiff_t count, double &ax, double &ay) const
+    {
+        for (std::ptrdiff_t j = 0; j < count; ++j)
+        {
+            (*this)(ox[j] - x, oy[j] - y, omass[j], ax, ay);
+        }
+    }
+};
+
+/**
+ * Python-facing handle to a single particle of a ParticleStore. It holds no state of its own;
+ * every access reads or writes the store.
+ */
+struct Particle
+{
+    ParticleStore *store {nullptr};
+    std::size_t index {0};
+
+    double get(const Field f) const
+    {
+        return store->field(f)[index];
+    }
+
+    void set(const Field f, const double value)
     {
-        vx += ax * dt;
-        vy += ay * dt;
-        x += vx * dt;
-        y += vy * dt;
-        ax = 0.0;
-        ay = 0.0;
+        store->field(f)[index] = value;
     }
 
     void print()
     {
-        std::cout << "<" << x << "," << y << ">" << std::endl;
+        std::cout << "<" << get(Field::x) << "," << get(Field::y) << ">" << std::endl;
     }
-};
\ No newline at end of file
+};
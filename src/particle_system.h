@@ -1,69 +1,431 @@
 #pragma once
 
+#include <algorithm>
 #include <array>
+#include <atomic>
+#include <memory>
 #include <random>
+#include <stdexcept>
+#include <string>
+#include <type_traits>
 #include <vector>
 
+#include "fmm.h"
+#include "parallel.h"
 #include "particle.h"
+#include "pm.h"
 #include "quadtree.h"
 
+/**
+ * The methods a system can accumulate the forces on its particles with.
+ */
+enum class Engine
+{
+    barnes_hut,  // every particle walks the tree, opening cells that fail the opening angle
+    fmm,         // cells exchange multipole and local expansions in a dual-tree walk
+    direct,      // every pair of particles interacts; no tree is built
+    pm,          // forces are interpolated from a mesh; no tree is built
+    treepm       // the mesh carries the long-range part of the force and a tree walk the rest
+};
+
+// below this many particles building and walking a tree costs more than summing every pair
+constexpr std::size_t direct_crossover = 256;
+
+/**
+ * Looks up an engine by name. "auto" picks direct summation for systems smaller than
+ * direct_crossover and Barnes-Hut for anything larger.
+ *
+ * Arguments:
+ *     name: one of "barnes_hut", "fmm", "direct", "pm", "treepm" or "auto"
+ *     num_particles: size of the system the engine is for
+ */
+inline Engine engine_from_name(const std::string &name, const std::size_t num_particles)
+{
+    if (name == "barnes_hut")
+    {
+        return Engine::barnes_hut;
+    }
+    if (name == "fmm")
+    {
+        return Engine::fmm;
+    }
+    if (name == "direct")
+    {
+        return Engine::direct;
+    }
+    if (name == "pm")
+    {
+        return Engine::pm;
+    }
+    if (name == "treepm")
+    {
+        return Engine::treepm;
+    }
+    if (name == "auto")
+    {
+        return num_particles < direct_crossover ? Engine::direct : Engine::barnes_hut;
+    }
+    throw std::invalid_argument("unknown engine '" + name + "'; expected 'barnes_hut', 'fmm', 'direct', 'pm', 'treepm' or 'auto'");
+}
+
+/**
+ * Checks a requested particle count, which must leave room for the central body that is always
+ * the last particle.
+ */
+inline std::size_t particle_count(const int num_particles)
+{
+    if (num_particles < 1)
+    {
+        throw std::invalid_argument("num_particles must be at least 1, for the central body");
+    }
+    return static_cast<std::size_t>(num_particles);
+}
 
 struct ParticleSystem {
     std::array<double, 2> ll {-1, -1};
     std::array<double, 2> ur {1, 1};
     QuadTree qt;
     double theta;
+    Kernel kernel = Kernel::fast;
+    Engine engine = Engine::barnes_hut;
+    FastMultipole fmm;                // expansions used when the engine is Engine::fmm
+    ParticleMesh mesh;                // mesh used when the engine is Engine::pm or Engine::treepm
+    double softening = 0.0;           // Plummer softening length
+    std::size_t group_size = 0;       // most particles that share a tree walk; 0 walks every particle on its own
+    std::vector<InteractionList> lists;  // one interaction list per worker for the group walks
+    double refit_threshold = 0.0;     // growth of the walk cost a refitted tree may reach before it is rebuilt; 0 always rebuilds
+    std::atomic<std::size_t> visits {0};  // nodes visited by the force walks since the tree was last built or refitted
+    std::size_t built_visits = 0;     // nodes visited by the walks over the tree as it was last built
+    bool fresh = false;               // whether the tree was built, rather than refitted, before the last walks
+    std::size_t tree_generation = 0;  // incremented every time the tree is rebuilt or refitted
+    std::vector<double> partial_bounds;  // largest absolute coordinate each worker integrated this step
+
+    std::shared_ptr<std::vector<double>> extents_buffer;  // memoised leaf extents of the current tree
+    std::size_t extents_generation = 0;                   // tree generation the memoised extents belong to
 
     ParticleSystem(const int num_particles, const double bounds, const double default_theta, const int seed=1337):
         ll {-bounds, -bounds},
         ur {bounds, bounds},
-        theta (default_theta)
+        theta (default_theta),
+        particles (particle_count(num_particles))
     {
         std::mt19937 eng(seed);
         std::uniform_real_distribution<double> dis(-bounds, bounds);
-        particles.reserve(num_particles);
+        auto x = particles.x();
+        auto y = particles.y();
         for (auto i = 0; i < num_particles-1; ++i) {
-            auto &p = particles.emplace_back(dis(eng), dis(eng));
+            // y is drawn first on purpose: GCC evaluated the arguments of the original
+            // emplace_back(dis(eng), dis(eng)) right to left, and this keeps seeds reproducible
+            y[i] = dis(eng);
+            x[i] = dis(eng);
         }
-        particles.emplace_back(0, 0, 0, 0, 0, 0, 1e12);
+        particles.m()[num_particles-1] = 1e12;
+    }
+
+    /**
+     * Moves the particles into a fresh buffer that the workers write first, each copying its own
+     * slice of every field, so that on a NUMA host each slice lives on the node of the worker
+     * that integrates it.
+     */
+    void place_particles(const Workers &workers)
+    {
+        auto n = particles.size();
+        ParticleStore::Buffer placed(particles.data.size());
+        workers.run([&](std::size_t w)
+        {
+            auto [begin, end] = workers.slice(n, w);
+            for (std::size_t f = 0; f < ParticleStore::num_fields; ++f)
+            {
+                std::copy(particles.data.begin() + f * n + begin, particles.data.begin() + f * n + end, placed.begin() + f * n + begin);
+            }
+        });
+        particles.data.swap(placed);
     }
 
-    void build_tree()
+    /**
+     * Brings the tree up to date with the particles. With a refit threshold the existing tree is
+     * refitted instead, for as long as the force walks over it visit no more than that fraction
+     * more nodes than the walks over the freshly built tree did. Engines that do not walk the
+     * tree record no visits, so they always rebuild.
+     */
+    void build_tree(const Workers &workers = {})
     {
-        qt = {.theta=theta, .ll=ll, .ur=ur};
-        for (auto &e : particles)
+        if (fresh)
+        {
+            built_visits = visits;
+        }
+        fresh = !(refit_threshold > 0.0 && built_visits && visits <= (1.0 + refit_threshold) * built_visits && qt.refit(particles, workers));
+        if (fresh)
         {
-            qt.add(e);
+            qt.build(particles, theta, ll, ur, workers);
         }
-        qt.get_cogs();
+        if (group_size)
+        {
+            qt.collect_groups(group_size);
+        }
+        visits = 0;
+        ++tree_generation;
     }
 
+    /**
+     * Accumulates the forces on a slice of the particles. The slice is taken from the tree's
+     * Morton order, so each slice covers one spatially coherent region of the system.
+     */
     void collect_forces(std::size_t start, std::size_t count)
     {
+        if (kernel == Kernel::trig)
+        {
+            collect_forces(TrigKernel {softening * softening}, start, count);
+        }
+        else
+        {
+            collect_forces(FastKernel {softening * softening}, start, count);
+        }
+    }
+
+    template <typename K>
+    void collect_forces(const K &k, std::size_t start, std::size_t count)
+    {
+        auto ax = particles.ax();
+        auto ay = particles.ay();
+        std::size_t walked = 0;
         for (auto i = start; i < start + count; ++i) {
-            qt.force(particles[i]);
+            auto p = qt.order[i];
+            walked += qt.force(k, static_cast<std::int32_t>(i), ax[p], ay[p]);
         }
+        visits += walked;
     }
 
-    void integrate(const double delta_time) {
-        double bounds = 0.0;
-        for (auto &e : particles)
+    /**
+     * Accumulates the forces on a slice of the particles by summing over every other particle.
+     * Sources are taken a tile at a time, and every target of a block is run against a tile
+     * before the next tile is loaded, so the tile stays in cache while it is reused.
+     */
+    void collect_direct_forces(std::size_t start, std::size_t count)
+    {
+        if (kernel == Kernel::trig)
+        {
+            collect_direct_forces(TrigKernel {softening * softening}, start, count);
+        }
+        else
         {
-            e.integrate(delta_time);
+            collect_direct_forces(FastKernel {softening * softening}, start, count);
+        }
+    }
 
-            if (std::abs(e.x) > bounds)
+    template <typename K>
+    void collect_direct_forces(const K &k, std::size_t start, std::size_t count)
+    {
+        if constexpr (std::is_same_v<K, FastKernel>)
+        {
+            if (qt.precision == Precision::single)
             {
-                bounds = std::abs(e.x);
+                collect_direct_forces_single(k, start, count);
+                return;
             }
-            if (std::abs(e.y) > bounds)
+        }
+        constexpr std::size_t block_size = 64;   // targets sharing each pass over a tile
+        constexpr std::size_t tile_size = 1024;  // sources per tile; three runs of these fit in L1/L2
+        const auto x = particles.x();
+        const auto y = particles.y();
+        const auto m = particles.m();
+        auto ax = particles.ax();
+        auto ay = particles.ay();
+        auto n = particles.size();
+        for (auto block = start; block < start + count; block += block_size)
+        {
+            auto block_end = std::min(block + block_size, start + count);
+            for (std::size_t tile = 0; tile < n; tile += tile_size)
             {
-                bounds = std::abs(e.y);
+                auto tile_end = std::min(tile + tile_size, n);
+                for (auto i = block; i < block_end; ++i)
+                {
+                    if (i >= tile && i < tile_end)
+                    {
+                        // skip the particle itself by interacting with the runs on either side of it
+                        k(x[i], y[i], x + tile, y + tile, m + tile, i - tile, ax[i], ay[i]);
+                        k(x[i], y[i], x + i + 1, y + i + 1, m + i + 1, tile_end - i - 1, ax[i], ay[i]);
+                    }
+                    else
+                    {
+                        k(x[i], y[i], x + tile, y + tile, m + tile, tile_end - tile, ax[i], ay[i]);
+                    }
+                }
             }
         }
+    }
+
+    /**
+     * As collect_direct_forces, with every interaction evaluated in single precision. Each tile
+     * is converted to offsets from the first target of the block it is run against, and the
+     * targets with it.
+     */
+    void collect_direct_forces_single(const FastKernel &k, std::size_t start, std::size_t count)
+    {
+        constexpr std::size_t block_size = 64;
+        constexpr std::size_t tile_size = 1024;
+        const auto x = particles.x();
+        const auto y = particles.y();
+        const auto m = particles.m();
+        auto ax = particles.ax();
+        auto ay = particles.ay();
+        auto n = particles.size();
+        std::vector<float> fx(tile_size), fy(tile_size), fm(tile_size);
+        std::vector<float> tx(block_size), ty(block_size);
+        for (auto block = start; block < start + count; block += block_size)
+        {
+            auto block_end = std::min(block + block_size, start + count);
+            auto x0 = x[block];
+            auto y0 = y[block];
+            for (auto i = block; i < block_end; ++i)
+            {
+                tx[i - block] = static_cast<float>(x[i] - x0);
+                ty[i - block] = static_cast<float>(y[i] - y0);
+            }
+            for (std::size_t tile = 0; tile < n; tile += tile_size)
+            {
+                auto tile_end = std::min(tile + tile_size, n);
+                for (auto j = tile; j < tile_end; ++j)
+                {
+                    fx[j - tile] = static_cast<float>(x[j] - x0);
+                    fy[j - tile] = static_cast<float>(y[j] - y0);
+                    fm[j - tile] = static_cast<float>(m[j]);
+                }
+                for (auto i = block; i < block_end; ++i)
+                {
+                    auto px = tx[i - block];
+                    auto py = ty[i - block];
+                    if (i >= tile && i < tile_end)
+                    {
+                        auto self = static_cast<std::ptrdiff_t>(i - tile);
+                        k(px, py, fx.data(), fy.data(), fm.data(), self, ax[i], ay[i]);
+                        k(px, py, fx.data() + self + 1, fy.data() + self + 1, fm.data() + self + 1, tile_end - i - 1, ax[i], ay[i]);
+                    }
+                    else
+                    {
+                        k(px, py, fx.data(), fy.data(), fm.data(), tile_end - tile, ax[i], ay[i]);
+                    }
+                }
+            }
+        }
+    }
+
+    /**
+     * Accumulates the forces on the particles of a range of the tree's groups, with one walk of
+     * the tree per group.
+     */
+    void collect_group_forces(std::size_t start, std::size_t count, InteractionList &list)
+    {
+        if (kernel == Kernel::trig)
+        {
+            collect_group_forces(TrigKernel {softening * softening}, start, count, list);
+        }
+        else
+        {
+            collect_group_forces(FastKernel {softening * softening}, start, count, list);
+        }
+    }
+
+    template <typename K>
+    void collect_group_forces(const K &k, std::size_t start, std::size_t count, InteractionList &list)
+    {
+        std::size_t walked = 0;
+        for (auto g = start; g < start + count; ++g)
+        {
+            walked += qt.group_force(k, qt.groups[g], list, particles.ax(), particles.ay());
+        }
+        visits += walked;
+    }
+
+    /**
+     * Kicks and drifts one particle and clears its acceleration for the next step.
+     *
+     * Returns:
+     *     the particle's largest absolute coordinate, from which the new bounds are taken
+     */
+    double integrate(const std::size_t i, const double delta_time)
+    {
+        auto x = particles.x();
+        auto y = particles.y();
+        auto vx = particles.vx();
+        auto vy = particles.vy();
+        auto ax = particles.ax();
+        auto ay = particles.ay();
+        vx[i] += ax[i] * delta_time;
+        vy[i] += ay[i] * delta_time;
+        x[i] += vx[i] * delta_time;
+        y[i] += vy[i] * delta_time;
+        ax[i] = 0.0;
+        ay[i] = 0.0;
+        return std::max(std::abs(x[i]), std::abs(y[i]));
+    }
+
+    /**
+     * Integrates the particles of a run of the tree's Morton order. The walks only read the
+     * tree's own copies of the positions, so a run can be moved as soon as its forces are
+     * complete, while other workers are still walking.
+     *
+     * Returns:
+     *     the largest absolute coordinate among the run's particles
+     */
+    double integrate_sorted(const std::size_t start, const std::size_t count, const double delta_time)
+    {
+        double bounds = 0.0;
+        for (auto k = start; k < start + count; ++k)
+        {
+            bounds = std::max(bounds, integrate(qt.order[k], delta_time));
+        }
+        return bounds;
+    }
+
+    /**
+     * Integrates every particle, each worker taking its own slice and keeping its own partial
+     * bound, then takes the new bounds from those.
+     */
+    void integrate(const double delta_time, const Workers &workers = {})
+    {
+        partial_bounds.assign(workers.count, 0.0);
+        workers.run([&](std::size_t w)
+        {
+            auto [begin, end] = workers.slice(particles.size(), w);
+            double bounds = 0.0;
+            for (auto i = begin; i < end; ++i)
+            {
+                bounds = std::max(bounds, integrate(i, delta_time));
+            }
+            partial_bounds[w] = bounds;
+        });
+        reduce_bounds();
+    }
+
+    /**
+     * Sets the bounds for the next tree from the workers' partial bounds.
+     */
+    void reduce_bounds()
+    {
+        auto bounds = *std::max_element(partial_bounds.begin(), partial_bounds.end());
         ll = {-bounds, -bounds};
         ur = {bounds, bounds};
     }
 
+    /**
+     * Sets the bounds for the next tree from the particles' current positions, and has the next
+     * tree built afresh rather than refitted; for positions written from outside a step.
+     */
+    void fit_bounds()
+    {
+        auto x = particles.x();
+        auto y = particles.y();
+        partial_bounds.assign(1, 0.0);
+        for (std::size_t i = 0; i < particles.size(); ++i)
+        {
+            partial_bounds[0] = std::max(partial_bounds[0], std::max(std::abs(x[i]), std::abs(y[i])));
+        }
+        reduce_bounds();
+        fresh = false;
+        built_visits = 0;
+    }
+
     std::vector<std::array<double, 4>> get_extents()
     {
         std::vector<std::array<double, 4>> extents;
@@ -71,5 +433,24 @@ struct ParticleSystem {
         return extents;
     }
 
-    std::vector<Particle> particles;
+    /**
+     * Returns the extents of every occupied leaf as a flat buffer of (x0, y0, x1, y1) rows. The
+     * buffer is sized from the leaf count of the current tree, filled once, and shared by every
+     * caller until the tree is rebuilt; a rebuild allocates a fresh buffer rather than
+     * overwriting one that may still be referenced.
+     */
+    std::shared_ptr<std::vector<double>> get_extents_buffer()
+    {
+        if (!extents_buffer || extents_generation != tree_generation)
+        {
+            auto buffer = std::make_shared<std::vector<double>>(4 * qt.num_leaves);
+            auto out = buffer->data();
+            qt.get_extents(out);
+            extents_buffer = std::move(buffer);
+            extents_generation = tree_generation;
+        }
+        return extents_buffer;
+    }
+
+    ParticleStore particles;
 };
@@ -0,0 +1,372 @@
+#pragma once
+
+#include <algorithm>
+#include <array>
+#include <cmath>
+#include <complex>
+#include <cstddef>
+#include <numbers>
+#include <stdexcept>
+#include <string>
+#include <tuple>
+#include <vector>
+
+#include "parallel.h"
+#include "particle.h"
+
+/**
+ * The short-range half of a TreePM force split: Newtonian gravity with its long-range part, the
+ * part the mesh carries, taken out. Beyond cutoff the remainder is negligible, and the tree walk
+ * skips any cell that lies entirely further away than that.
+ */
+struct ShortRangeKernel
+{
+    double eps2 {0.0};    // squared softening length
+    double rs {1.0};      // split radius
+    double cutoff {4.5};  // distance past which the force is dropped
+
+    static constexpr std::size_t table_size = 1024;  // samples of the short-range share
+    static constexpr double table_reach = 2.5;       // largest r / (2 rs) sampled, past the usual cutoff
+
+    static double exact_share(const double u)
+    {
+        return std::erfc(u) + 2.0 * u * std::exp(-u * u) / std::sqrt(std::numbers::pi);
+    }
+
+    /**
+     * Returns the short-range share sampled at table_size + 1 even steps of r / (2 rs).
+     */
+    static const std::vector<double> &table()
+    {
+        static const std::vector<double> samples = []
+        {
+            std::vector<double> t(table_size + 1);
+            for (std::size_t k = 0; k <= table_size; ++k)
+            {
+                t[k] = exact_share(table_reach * static_cast<double>(k) / table_size);
+            }
+            return t;
+        }();
+        return samples;
+    }
+
+    /**
+     * Fraction of the Newtonian force at distance r that is short-ranged, interpolated from the
+     * table rather than paying for erfc and exp on every interaction.
+     */
+    double share(const double r) const
+    {
+        auto u = r / (2.0 * rs) * (table_size / table_reach);
+        if (u >= table_size)
+        {
+            return exact_share(r / (2.0 * rs));
+        }
+        const auto &t = table();
+        auto k = static_cast<std::size_t>(u);
+        auto f = u - static_cast<double>(k);
+        return t[k] + f * (t[k + 1] - t[k]);
+    }
+
+    void operator()(const double dx, const double dy, const double omass, double &ax, double &ay) const
+    {
+        double d2 = dx * dx + dy * dy;
+        double r2 = d2 + eps2;
+        double inv = 1.0 / std::sqrt(r2);
+        double f = G * omass * inv * inv * inv * share(std::sqrt(d2));
+        ax += f * dx;
+        ay += f * dy;
+    }
+
+    void operator()(const double x, const double y, const double *ox, const double *oy, const double *omass, const std::ptrdiff_t count, double &ax, double &ay) const
+    {
+        for (std::ptrdiff_t j = 0; j < count; ++j)
+        {
+            (*this)(ox[j] - x, oy[j] - y, omass[j], ax, ay);
+        }
+    }
+};
+
+/**
+ * Particle-mesh gravity. Masses are deposited onto a square mesh covering the system bounds with
+ * cloud-in-cell weights, the mesh is convolved with the force kernel by FFT, and the resulting
+ * field is interpolated back to the particles with the same weights.
+ *
+ * The particles feel the 1/r potential rather than the logarithmic one of two-dimensional
+ * gravity, so the mesh does not solve Poisson's equation in the plane; it convolves with the
+ * real-space force kernel itself over a mesh padded to twice its size, which keeps the system
+ * isolated rather than periodic. The x and y kernels are transformed together as the real and
+ * imaginary parts of one complex kernel, so each step takes one forward and one inverse FFT.
+ *
+ * With a non-zero split the mesh carries only the long-range part of the force, leaving the
+ * rest to a ShortRangeKernel walk of the tree (TreePM).
+ */
+struct ParticleMesh
+{
+    std::size_t mesh_size = 256;   // cells per side of the mesh the particles are deposited on
+    double split = 0.0;            // split radius in cells; 0 puts the whole force on the mesh
+
+    std::vector<std::complex<double>> green;     // transform of the (x + i y) force kernel over the padded mesh
+    std::vector<std::complex<double>> grid;      // padded mesh: density, then its transform, then the field
+    std::vector<double> deposits;                // one mesh of deposited mass per worker
+    std::vector<std::complex<double>> columns;   // one column of the padded mesh per worker
+    std::vector<std::complex<double>> twiddles;  // exp(-2 pi i k / padded()) for k below padded() / 2
+    std::vector<std::size_t> reversed;           // bit-reversal permutation of padded() entries
+
+    ParticleMesh(const std::size_t cells = 256, const double split_cells = 0.0):
+        mesh_size(cells),
+        split(split_cells)
+    {
+        if (mesh_size < 4 || (mesh_size & (mesh_size - 1)))
+        {
+            throw std::invalid_argument("mesh size must be a power of two no smaller than 4, not " + std::to_string(mesh_size));
+        }
+    }
+
+    std::size_t padded() const
+    {
+        return 2 * mesh_size;
+    }
+
+    /**
+     * Returns the side length of a mesh cell for the given bounds. The mesh reaches one cell past
+     * the bounds on every side, so the clouds of particles on the bounds stay on the mesh.
+     */
+    double cell_width(const std::array<double, 2> &ll, const std::array<double, 2> &ur) const
+    {
+        return std::max(ur[0] - ll[0], ur[1] - ll[1]) / static_cast<double>(mesh_size - 2);
+    }
+
+    /**
+     * Accumulates the mesh acceleration of every particle of a store.
+     *
+     * Arguments:
+     *     store: the particles to deposit and accumulate accelerations for
+     *     ll, ur: bounds of the system
+     *     workers: workers to share the deposit, the transforms and the interpolation between
+     */
+    void evaluate(ParticleStore &store, const std::array<double, 2> &ll, const std::array<double, 2> &ur, const Workers &workers)
+    {
+        auto n = store.size();
+        auto cells = mesh_size;
+        auto p = padded();
+        if (green.empty())
+        {
+            _prepare(workers);
+        }
+        auto h = cell_width(ll, ur);
+        if (!n || !(h > 0.0))
+        {
+            return;
+        }
+        std::array<double, 2> origin {ll[0] - h, ll[1] - h};
+
+        // every worker deposits its slice of the particles onto a mesh of its own...
+        deposits.resize(workers.count * cells * cells);
+        workers.run([&](std::size_t w)
+        {
+            auto mesh = deposits.data() + w * cells * cells;
+            std::fill(mesh, mesh + cells * cells, 0.0);
+            auto [begin, end] = workers.slice(n, w);
+            for (auto k = begin; k < end; ++k)
+            {
+                auto [i, j, fx, fy] = _cloud(store.x()[k], store.y()[k], origin, h);
+                auto m = store.m()[k];
+                mesh[i * cells + j] += m * (1.0 - fx) * (1.0 - fy);
+                mesh[i * cells + j + 1] += m * (1.0 - fx) * fy;
+                mesh[(i + 1) * cells + j] += m * fx * (1.0 - fy);
+                mesh[(i + 1) * cells + j + 1] += m * fx * fy;
+            }
+        });
+
+        // ...and the meshes are summed into the corner of the zero-padded one
+        grid.resize(p * p);
+        workers.run([&](std::size_t w)
+        {
+            auto [begin, end] = workers.slice(p, w);
+            for (auto i = begin; i < end; ++i)
+            {
+                auto row = grid.data() + i * p;
+                std::fill(row, row + p, 0.0);
+                if (i >= cells)
+                {
+                    continue;
+                }
+                for (std::size_t v = 0; v < workers.count; ++v)
+                {
+                    auto mesh = deposits.data() + v * cells * cells + i * cells;
+                    for (std::size_t j = 0; j < cells; ++j)
+                    {
+                        row[j] += mesh[j];
+                    }
+                }
+            }
+        });
+
+        _transform(false, workers);
+        workers.run([&](std::size_t w)
+        {
+            auto [begin, end] = workers.slice(p * p, w);
+            for (auto k = begin; k < end; ++k)
+            {
+                grid[k] *= green[k];
+            }
+        });
+        _transform(true, workers);
+
+        // the kernel was built in units of cells, and the inverse transform is left unnormalised
+        auto scale = G / (h * h * static_cast<double>(p * p));
+        workers.run([&](std::size_t w)
+        {
+            auto [begin, end] = workers.slice(n, w);
+            for (auto k = begin; k < end; ++k)
+            {
+                auto [i, j, fx, fy] = _cloud(store.x()[k], store.y()[k], origin, h);
+                auto field = grid[i * p + j] * ((1.0 - fx) * (1.0 - fy))
+                           + grid[i * p + j + 1] * ((1.0 - fx) * fy)
+                           + grid[(i + 1) * p + j] * (fx * (1.0 - fy))
+                           + grid[(i + 1) * p + j + 1] * (fx * fy);
+                store.ax()[k] += scale * field.real();
+                store.ay()[k] += scale * field.imag();
+            }
+        });
+    }
+
+    /**
+     * Returns the mesh cell at the lower left of a particle's cloud and the particle's fractional
+     * offset from that cell's centre; the cloud covers that cell and the three above and right
+     * of it.
+     */
+    std::tuple<std::size_t, std::size_t, double, double> _cloud(const double x, const double y, const std::array<double, 2> &origin, const double h) const
+    {
+        auto top = static_cast<double>(mesh_size - 2);
+        auto u = std::clamp((x - origin[0]) / h - 0.5, 0.0, top);
+        auto v = std::clamp((y - origin[1]) / h - 0.5, 0.0, top);
+        auto i = std::min(static_cast<std::size_t>(u), mesh_size - 2);
+        auto j = std::min(static_cast<std::size_t>(v), mesh_size - 2);
+        return {i, j, u - static_cast<double>(i), v - static_cast<double>(j)};
+    }
+
+    /**
+     * Sets up the FFT tables and transforms the force kernel. The kernel is built in units of
+     * cells, so it only depends on the mesh size and the split and is reused across steps even
+     * as the bounds change.
+     */
+    void _prepare(const Workers &workers)
+    {
+        auto p = padded();
+        twiddles.resize(p / 2);
+        for (std::size_t k = 0; k < p / 2; ++k)
+        {
+            twiddles[k] = std::polar(1.0, -2.0 * std::numbers::pi * static_cast<double>(k) / static_cast<double>(p));
+        }
+        reversed.resize(p);
+        auto bits = 0;
+        while ((std::size_t{1} << bits) < p)
+        {
+            ++bits;
+        }
+        for (std::size_t k = 0; k < p; ++k)
+        {
+            std::size_t r = 0;
+            for (auto b = 0; b < bits; ++b)
+            {
+                r |= ((k >> b) & 1) << (bits - 1 - b);
+            }
+            reversed[k] = r;
+        }
+
+        // the field at a cell is the sum over source cells of their mass times the kernel at
+        // (target - source), which pulls towards the source; offsets past the mesh wrap around
+        grid.assign(p * p, 0.0);
+        auto offset = [p](const std::size_t k) { return k < p / 2 ? static_cast<double>(k) : static_cast<double>(k) - static_cast<double>(p); };
+        for (std::size_t i = 0; i < p; ++i)
+        {
+            for (std::size_t j = 0; j < p; ++j)
+            {
+                auto dx = offset(i);
+                auto dy = offset(j);
+                auto r2 = dx * dx + dy * dy;
+                if (r2 == 0.0 || i == mesh_size || j == mesh_size)
+                {
+                    continue;
+                }
+                auto r = std::sqrt(r2);
+                auto share = 1.0;
+                if (split > 0.0)
+                {
+                    auto u = r / (2.0 * split);
+                    share = std::erf(u) - 2.0 * u * std::exp(-u * u) / std::sqrt(std::numbers::pi);
+                }
+                auto f = -share / (r2 * r);
+                grid[i * p + j] = {f * dx, f * dy};
+            }
+        }
+        _transform(false, workers);
+        green = grid;
+    }
+
+    /**
+     * Transforms the padded mesh in place: every row, then every column.
+     */
+    void _transform(const bool inverse, const Workers &workers)
+    {
+        auto p = padded();
+        columns.resize(workers.count * p);
+        workers.run([&](std::size_t w)
+        {
+            auto [begin, end] = workers.slice(p, w);
+            for (auto i = begin; i < end; ++i)
+            {
+                _fft(grid.data() + i * p, inverse);
+            }
+        });
+        workers.run([&](std::size_t w)
+        {
+            auto column = columns.data() + w * p;
+            auto [begin, end] = workers.slice(p, w);
+            for (auto j = begin; j < end; ++j)
+            {
+                for (std::size_t i = 0; i < p; ++i)
+                {
+                    column[i] = grid[i * p + j];
+                }
+                _fft(column, inverse);
+                for (std::size_t i = 0; i < p; ++i)
+                {
+                    grid[i * p + j] = column[i];
+                }
+            }
+        });
+    }
+
+    /**
+     * Iterative radix-2 FFT of padded() entries, in place and unnormalised.
+     */
+    void _fft(std::complex<double> *a, const bool inverse) const
+    {
+        auto p = padded();
+        for (std::size_t k = 0; k < p; ++k)
+        {
+            if (k < reversed[k])
+            {
+                std::swap(a[k], a[reversed[k]]);
+            }
+        }
+        for (std::size_t len = 2; len <= p; len <<= 1)
+        {
+            auto stride = p / len;
+            auto half = len / 2;
+            for (std::size_t start = 0; start < p; start += len)
+            {
+                for (std::size_t k = 0; k < half; ++k)
+                {
+                    auto w = inverse ? std::conj(twiddles[k * stride]) : twiddles[k * stride];
+                    auto u = a[start + k];
+                    auto v = a[start + k + half] * w;
+                    a[start + k] = u + v;
+                    a[start + k + half] = u - v;
+                }
+            }
+        }
+    }
+};
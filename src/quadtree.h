@@ -1,224 +1,857 @@
 #pragma once
 
+#include <algorithm>
 #include <array>
+#include <atomic>
+#include <cassert>
+#include <cmath>
+#include <cstddef>
+#include <cstdint>
 #include <iostream>
-#include <memory>
+#include <limits>
+#include <type_traits>
+#include <utility>
+#include <vector>
 
+#include "parallel.h"
 #include "particle.h"
 
+/**
+ * Spreads the low 21 bits of a value out to the even bits of a 64-bit word.
+ */
+inline std::uint64_t spread_bits(std::uint64_t v)
+{
+    v &= 0x1fffff;
+    v = (v | v << 16) & 0x0000ffff0000ffff;
+    v = (v | v << 8) & 0x00ff00ff00ff00ff;
+    v = (v | v << 4) & 0x0f0f0f0f0f0f0f0f;
+    v = (v | v << 2) & 0x3333333333333333;
+    v = (v | v << 1) & 0x5555555555555555;
+    return v;
+}
+
+/**
+ * A single square cell of a QuadTree. Nodes refer to their children by index, and to the
+ * particles they hold as a range of the tree's Morton-sorted particle order, so a whole tree
+ * lives in one contiguous pool.
+ */
+struct QuadNode
+{
+    std::array<double, 2> ll {-1.0, -1.0};          // lower-left corner of the cell
+    double width {2.0};                             // side length of the cell
+
+    std::array<double, 2> center {0.0, 0.0};        // centre of mass of everything in the cell
+    double m {0.0};                                 // total mass of everything in the cell
+    std::array<double, 3> quadrupole {0.0, 0.0, 0.0};  // xx, xy, yy of the traceless quadrupole about the centre of mass
+
+    std::array<std::int32_t, 4> children {-1, -1, -1, -1};  // ne, nw, sw, se; -1 if absent
+    std::int32_t first {0};                                  // first entry of the cell in the sorted order
+    std::int32_t count {0};                                  // number of particles in the cell
+    std::int32_t next {-1};                                  // first child, or skip for a leaf
+    std::int32_t skip {-1};                                  // node after the whole cell in a depth-first walk; -1 past the end
+
+    bool is_leaf() const
+    {
+        return children[0] < 0 && children[1] < 0 && children[2] < 0 && children[3] < 0;
+    }
+};
+
+/**
+ * Scratch space for the interaction list of one group walk: the point masses every member of the
+ * group interacts with, as one contiguous block, plus the accepted cells whose quadrupoles apply.
+ */
+struct InteractionList
+{
+    std::vector<double> x, y, m;      // positions and masses of the point masses
+    std::vector<float> fx, fy, fm;    // the same, in single precision and relative to origin
+    std::vector<std::int32_t> cells;  // accepted cells, for their quadrupoles
+    std::vector<std::array<std::int32_t, 3>> own;  // first, count and list offset of each leaf of the group itself
+    bool single = false;              // whether the point masses go into the single-precision runs
+    std::array<double, 2> origin {0.0, 0.0};  // point the single-precision positions are relative to
+
+    void clear()
+    {
+        x.clear();
+        y.clear();
+        m.clear();
+        fx.clear();
+        fy.clear();
+        fm.clear();
+        cells.clear();
+        own.clear();
+    }
+
+    std::size_t size() const
+    {
+        return single ? fx.size() : x.size();
+    }
+
+    void push(const double px, const double py, const double pm)
+    {
+        if (single)
+        {
+            fx.push_back(static_cast<float>(px - origin[0]));
+            fy.push_back(static_cast<float>(py - origin[1]));
+            fm.push_back(static_cast<float>(pm));
+        }
+        else
+        {
+            x.push_back(px);
+            y.push_back(py);
+            m.push_back(pm);
+        }
+    }
+};
+
+/**
+ * Barnes-Hut quadtree over the particles of a ParticleStore. Particles are sorted along a Morton
+ * (Z-order) curve and the tree is cut out of the sorted order, so every cell covers a contiguous
+ * range of it. Nodes are allocated from a flat pool that is cleared, not freed, between steps, so
+ * rebuilding the tree reuses the same storage.
+ */
 struct QuadTree
 {
+    static constexpr int max_depth = 21;  // levels resolvable by the 21 bits per axis of a key
+
     double theta = 0.5;
+    std::size_t leaf_capacity = 8;       // most particles a cell may hold before it is split
+    bool use_quadrupole = false;         // weigh cells' quadrupoles too, and add them to far-field interactions
+    Precision precision = Precision::full;  // precision group_force sums its interaction lists in
+    std::vector<QuadNode> nodes;         // node pool; the root is node 0 and children follow their parents
+    std::size_t num_leaves = 0;          // number of occupied leaves
+
+    std::vector<std::int32_t> groups;    // cells that share a walk in group_force; see collect_groups
+    std::vector<std::int32_t> order;     // particle indices sorted by Morton key
+    std::vector<std::uint64_t> keys;     // Morton key of each entry of order
+    std::vector<double> sx, sy, sm;      // positions and masses gathered into the sorted order
+    std::vector<std::int32_t> order_scratch;
+    std::vector<std::uint64_t> keys_scratch;
+    std::vector<std::size_t> histograms;  // per-worker digit counts of the radix sort
+
+    std::vector<std::pair<std::int32_t, int>> pending;  // cells (and their levels) left for the workers to split
+    std::vector<std::vector<QuadNode>> subtrees;         // descendants of each pending cell, built by the workers
+    std::vector<std::size_t> subtree_leaves;             // number of leaves in each of the subtrees
 
-    std::array<double, 2> ll {-1.0, -1.0};
-    std::array<double, 2> ur {1.0, 1.0};
+    static constexpr int digit_bits = 11;
+    static constexpr std::size_t buckets = std::size_t{1} << digit_bits;
 
-    Particle *particle {nullptr};
+    /**
+     * Rebuilds the tree over every particle of a store: keys the particles by their position
+     * within the bounds, sorts them along the Morton curve, then splits the sorted order into
+     * cells, computing each cell's mass and centre of mass as soon as its children are done.
+     * With more than one worker the top of the tree is split on the calling thread until the
+     * cells are small enough to be handed out, then the workers build (and weigh) the subtrees
+     * below them and splice them into the pool; only the few cells above them are weighed last.
+     *
+     * Arguments:
+     *     store: the particles to build the tree over
+     *     default_theta: Barnes-Hut opening angle used by force
+     *     ll, ur: bounds of the root cell
+     *     workers: workers to share the sort and the subtree builds between
+     */
+    void build(const ParticleStore &store, const double default_theta, const std::array<double, 2> &ll, const std::array<double, 2> &ur, const Workers &workers = {})
+    {
+        theta = default_theta;
+        auto width = std::max(ur[0] - ll[0], ur[1] - ll[1]);
+        _sort(store, ll, width, workers);
+
+        _gather_particles(store, workers);
+
+        nodes.clear();
+        pending.clear();
+        num_leaves = 0;
+        if (order.empty())
+        {
+            return;
+        }
+        nodes.push_back({.ll = ll, .width = width, .first = 0, .count = static_cast<std::int32_t>(order.size())});
+        auto grain = workers.count > 1 ? std::max<std::size_t>(order.size() / (8 * workers.count), 256) : 0;
+        num_leaves = _split(nodes, 0, 0, grain);
+        if (!pending.empty())
+        {
+            _build_subtrees(workers);
+        }
+        _thread();
+    }
 
-    std::unique_ptr<QuadTree> ne {nullptr};
-    std::unique_ptr<QuadTree> nw {nullptr};
-    std::unique_ptr<QuadTree> sw {nullptr};
-    std::unique_ptr<QuadTree> se {nullptr};
+    /**
+     * Refits the tree to the particles' new positions without changing its shape: every particle
+     * stays in the leaf it was sorted into, each cell's box is shrunk or grown to the smallest
+     * square holding its particles, and the moments are recomputed bottom-up. Cells may come to
+     * overlap, but every box still holds everything its node stands for, so the walks stay
+     * correct; they only get slower as particles stray from the cells they were sorted into and
+     * drag their cells' boxes after them, so the caller is left to judge when to rebuild.
+     *
+     * Arguments:
+     *     store: the particles the tree was built over, at their new positions
+     *     workers: workers to share the gather and the leaves between
+     *
+     * Returns:
+     *     false, leaving the tree untouched, if the tree does not cover the store's particles
+     */
+    bool refit(const ParticleStore &store, const Workers &workers = {})
+    {
+        if (nodes.empty() || order.size() != store.size())
+        {
+            return false;
+        }
+        _gather_particles(store, workers);
+        workers.run([&](std::size_t w)
+        {
+            auto [begin, end] = workers.slice(nodes.size(), w);
+            for (auto n = begin; n < end; ++n)
+            {
+                auto &node = nodes[n];
+                if (!node.is_leaf())
+                {
+                    continue;
+                }
+                double x0 = sx[node.first], x1 = x0;
+                double y0 = sy[node.first], y1 = y0;
+                for (auto k = node.first; k < node.first + node.count; ++k)
+                {
+                    x0 = std::min(x0, sx[k]);
+                    x1 = std::max(x1, sx[k]);
+                    y0 = std::min(y0, sy[k]);
+                    y1 = std::max(y1, sy[k]);
+                }
+                node.ll = {x0, y0};
+                node.width = std::max(x1 - x0, y1 - y0);
+                _gather(nodes, static_cast<std::int32_t>(n));
+            }
+        });
+        for (auto n = nodes.size(); n-- > 0;)
+        {
+            auto &node = nodes[n];
+            if (node.is_leaf())
+            {
+                continue;
+            }
+            auto x0 = std::numeric_limits<double>::infinity(), y0 = x0;
+            auto x1 = -x0, y1 = -x0;
+            for (auto c : node.children)
+            {
+                if (c >= 0)
+                {
+                    x0 = std::min(x0, nodes[c].ll[0]);
+                    y0 = std::min(y0, nodes[c].ll[1]);
+                    x1 = std::max(x1, nodes[c].ll[0] + nodes[c].width);
+                    y1 = std::max(y1, nodes[c].ll[1] + nodes[c].width);
+                }
+            }
+            node.ll = {x0, y0};
+            node.width = std::max(x1 - x0, y1 - y0);
+            _gather(nodes, static_cast<std::int32_t>(n));
+        }
+        return true;
+    }
 
-    std::array<double, 2> center {0.0, 0.0};
-    double m {0.0};
+    /**
+     * Copies the particles' positions and masses into sorted order, so every leaf is a
+     * contiguous block.
+     */
+    void _gather_particles(const ParticleStore &store, const Workers &workers)
+    {
+        sx.resize(order.size());
+        sy.resize(order.size());
+        sm.resize(order.size());
+        workers.run([&](std::size_t w)
+        {
+            auto [begin, end] = workers.slice(order.size(), w);
+            for (auto k = begin; k < end; ++k)
+            {
+                sx[k] = store.x()[order[k]];
+                sy[k] = store.y()[order[k]];
+                sm[k] = store.m()[order[k]];
+            }
+        });
+    }
 
-    std::unique_ptr<QuadTree>& _get_quadrant(Particle &e)
+    /**
+     * Builds the subtrees below the cells _split left pending on the workers, splices them into
+     * the pool and weighs the cells above them.
+     */
+    void _build_subtrees(const Workers &workers)
     {
-        double dxh = 0.5 * (ur[0] + ll[0]);
-        double dyh = 0.5 * (ur[1] + ll[1]);
-        if (e.x > dxh && e.y >= dyh)
+        subtrees.resize(pending.size());
+        subtree_leaves.resize(pending.size());
+        std::atomic<std::size_t> next {0};
+        workers.run([&](std::size_t)
         {
-            if (!ne)
+            for (auto p = next++; p < pending.size(); p = next++)
             {
-                ne.reset(new QuadTree {theta, {dxh, dyh}, ur});
+                auto &pool = subtrees[p];
+                pool.clear();
+                pool.push_back(nodes[pending[p].first]);
+                subtree_leaves[p] = _split(pool, 0, pending[p].second, 0);
             }
-            return ne;
+        });
+
+        // every subtree keeps its depth-first layout and lands after the top of the tree, so
+        // children still sit after their parents; its root is the pending cell itself
+        std::vector<std::size_t> offsets(pending.size());
+        auto top = nodes.size();
+        auto total = top;
+        for (std::size_t p = 0; p < pending.size(); ++p)
+        {
+            offsets[p] = total;
+            total += subtrees[p].size() - 1;
+            num_leaves += subtree_leaves[p];
         }
-        else if (e.x <= dxh && e.y > dyh)
+        nodes.resize(total);
+        next = 0;
+        workers.run([&](std::size_t)
         {
-            if (!nw)
+            for (auto p = next++; p < pending.size(); p = next++)
             {
-                nw.reset(new QuadTree {theta, {ll[0], dyh}, {dxh, ur[1]}});
+                const auto &pool = subtrees[p];
+                auto base = static_cast<std::int32_t>(offsets[p]) - 1;
+                for (std::size_t k = 0; k < pool.size(); ++k)
+                {
+                    auto &node = nodes[k ? base + k : pending[p].first];
+                    node = pool[k];
+                    for (auto &c : node.children)
+                    {
+                        if (c >= 0)
+                        {
+                            c += base;
+                        }
+                    }
+                }
             }
-            return nw;
+        });
+
+        // the pending cells now carry their subtrees' moments, so the cells above them can be
+        // weighed; they all sit in the top of the pool, children after parents
+        std::vector<bool> is_pending(top, false);
+        for (const auto &p : pending)
+        {
+            is_pending[p.first] = true;
         }
-        else if (e.x < dxh && e.y <= dyh)
+        for (auto n = top; n-- > 0;)
         {
-            if (!sw)
+            if (!is_pending[n] && !nodes[n].is_leaf())
             {
-                sw.reset(new QuadTree {theta, ll, {dxh, dyh}});
+                _gather(nodes, static_cast<std::int32_t>(n));
             }
-            return sw;
         }
-        else
+    }
+
+    /**
+     * Threads the tree for a stackless depth-first walk: every node learns the node to visit
+     * when it is opened (its first child) and the node to continue with once its whole cell is
+     * done (its next sibling, or its parent's skip). Children sit after their parents, so one
+     * forward sweep sees every parent's skip before its children need it.
+     */
+    void _thread()
+    {
+        if (nodes.empty())
         {
-            if (!se)
+            return;
+        }
+        nodes[0].skip = -1;
+        for (auto &node : nodes)
+        {
+            // link the children back to front, so each one continues with the sibling after it
+            auto after = node.skip;
+            for (auto c = node.children.rbegin(); c != node.children.rend(); ++c)
             {
-                se.reset(new QuadTree {theta, {dxh, ll[1]}, {ur[0], dyh}});
+                if (*c >= 0)
+                {
+                    nodes[*c].skip = after;
+                    after = *c;
+                }
             }
-            return se;
+            node.next = after;
         }
     }
 
-    void _subdivide(Particle &e)
+    /**
+     * Computes the Morton key of every particle and sorts the particle order by key with a
+     * least-significant-digit radix sort. Each worker keys, counts and scatters its own slice;
+     * slices are scattered in worker order, which keeps every pass stable.
+     */
+    void _sort(const ParticleStore &store, const std::array<double, 2> &ll, const double width, const Workers &workers)
     {
-        auto &existing_particle_quadrant = _get_quadrant(*particle);
-        auto _particle = particle;
-        particle = nullptr;
-        existing_particle_quadrant->add(*_particle);
+        constexpr std::uint64_t cells = std::uint64_t{1} << max_depth;
+
+        auto n = store.size();
+        auto scale = width > 0.0 ? static_cast<double>(cells) / width : 0.0;
+        order.resize(n);
+        keys.resize(n);
+        order_scratch.resize(n);
+        keys_scratch.resize(n);
+        histograms.resize(workers.count * buckets);
+
+        for (int shift = 0; shift < 2 * max_depth; shift += digit_bits)
+        {
+            workers.run([&](std::size_t w)
+            {
+                auto [begin, end] = workers.slice(n, w);
+                if (shift == 0)
+                {
+                    for (auto i = begin; i < end; ++i)
+                    {
+                        auto kx = std::clamp((store.x()[i] - ll[0]) * scale, 0.0, static_cast<double>(cells - 1));
+                        auto ky = std::clamp((store.y()[i] - ll[1]) * scale, 0.0, static_cast<double>(cells - 1));
+                        order[i] = static_cast<std::int32_t>(i);
+                        keys[i] = spread_bits(static_cast<std::uint64_t>(kx)) | spread_bits(static_cast<std::uint64_t>(ky)) << 1;
+                    }
+                }
+                auto counts = histograms.data() + w * buckets;
+                std::fill(counts, counts + buckets, 0);
+                for (auto i = begin; i < end; ++i)
+                {
+                    ++counts[(keys[i] >> shift) & (buckets - 1)];
+                }
+            });
 
-        auto &new_particle_quadrant = _get_quadrant(e);
-        new_particle_quadrant->add(e);
+            std::size_t total = 0;
+            for (std::size_t b = 0; b < buckets; ++b)
+            {
+                for (std::size_t w = 0; w < workers.count; ++w)
+                {
+                    auto c = histograms[w * buckets + b];
+                    histograms[w * buckets + b] = total;
+                    total += c;
+                }
+            }
+
+            workers.run([&](std::size_t w)
+            {
+                auto [begin, end] = workers.slice(n, w);
+                auto offsets = histograms.data() + w * buckets;
+                for (auto i = begin; i < end; ++i)
+                {
+                    auto dst = offsets[(keys[i] >> shift) & (buckets - 1)]++;
+                    keys_scratch[dst] = keys[i];
+                    order_scratch[dst] = order[i];
+                }
+            });
+            keys.swap(keys_scratch);
+            order.swap(order_scratch);
+        }
     }
 
-    void add(Particle &e)
+    /**
+     * Splits a cell of a pool into its occupied quadrants and recurses into each of them, so that
+     * the pool ends up in depth-first order. A cell stays a leaf once it holds no more than
+     * leaf_capacity particles, or once its keys can no longer tell its particles apart. Every cell
+     * is weighed once its children are. With a non-zero grain, cells of at most that many particles
+     * are left unsplit (and unweighed) and queued on pending instead.
+     *
+     * Returns:
+     *     number of leaves created below (and including) the cell
+     */
+    std::size_t _split(std::vector<QuadNode> &pool, const std::int32_t node, const int level, const std::size_t grain)
     {
-        if (ne || nw || sw || se)
+        auto first = pool[node].first;
+        auto count = pool[node].count;
+        if (static_cast<std::size_t>(count) <= leaf_capacity || level == max_depth)
         {
-            auto &particle_quadrant = _get_quadrant(e);
-            particle_quadrant->add(e);
+            _gather(pool, node);
+            return 1;
         }
-        else if (particle)
+        if (grain && static_cast<std::size_t>(count) <= grain)
         {
-            _subdivide(e);
+            pending.emplace_back(node, level);
+            return 0;
+        }
+
+        // quadrants in key order are sw, se, nw, ne; children are stored as ne, nw, sw, se
+        constexpr std::array<std::size_t, 4> child_slot {2, 3, 1, 0};
+        auto shift = 2 * (max_depth - 1 - level);
+        auto half = 0.5 * pool[node].width;
+        auto ll = pool[node].ll;
+        auto begin = keys.begin() + first;
+        auto end = begin + count;
+        std::size_t leaves = 0;
+        for (std::uint64_t q = 0; q < 4; ++q)
+        {
+            auto q_end = std::partition_point(begin, end, [&](std::uint64_t k) { return ((k >> shift) & 3) <= q; });
+            if (q_end != begin)
+            {
+                auto child = static_cast<std::int32_t>(pool.size());
+                pool.push_back({
+                    .ll = {ll[0] + ((q & 1) ? half : 0.0), ll[1] + ((q & 2) ? half : 0.0)},
+                    .width = half,
+                    .first = static_cast<std::int32_t>(begin - keys.begin()),
+                    .count = static_cast<std::int32_t>(q_end - begin)
+                });
+                // the push may reallocate the pool, so the parent is only ever addressed by index
+                pool[node].children[child_slot[q]] = child;
+                leaves += _split(pool, child, level + 1, grain);
+            }
+            begin = q_end;
+        }
+        _gather(pool, node);
+        return leaves;
+    }
+
+    /**
+     * Computes the mass and centre of mass of a node of a pool, from its particles if it is a
+     * leaf and from its children otherwise; the children's moments must already be final.
+     */
+    void _gather(std::vector<QuadNode> &pool, const std::int32_t n) const
+    {
+        auto &node = pool[n];
+        node.m = 0.0;
+        node.center = {0.0, 0.0};
+        if (node.is_leaf())
+        {
+            for (auto k = node.first; k < node.first + node.count; ++k)
+            {
+                node.center[0] += sx[k] * sm[k];
+                node.center[1] += sy[k] * sm[k];
+                node.m += sm[k];
+            }
         }
         else
         {
-            particle = &e;
+            for (auto c : node.children)
+            {
+                if (c >= 0)
+                {
+                    node.center[0] += pool[c].center[0] * pool[c].m;
+                    node.center[1] += pool[c].center[1] * pool[c].m;
+                    node.m += pool[c].m;
+                }
+            }
+        }
+        if (node.m > 0.0)
+        {
+            node.center[0] /= node.m;
+            node.center[1] /= node.m;
+        }
+        if (use_quadrupole)
+        {
+            _gather_quadrupole(pool, n);
         }
     }
 
-    void get_cogs()
+    /**
+     * Computes the quadrupole of a cell about its centre of mass, sum m (3 d d^T - |d|^2 I) over
+     * the offsets d of its particles from that centre. A leaf sums over its particles; any other
+     * cell shifts the quadrupoles of its children by the parallel axis theorem.
+     */
+    void _gather_quadrupole(std::vector<QuadNode> &pool, const std::int32_t n) const
     {
-        if (particle)
+        auto &node = pool[n];
+        node.quadrupole = {0.0, 0.0, 0.0};
+        auto add = [&node](const double mass, const double dx, const double dy)
+        {
+            node.quadrupole[0] += mass * (2.0 * dx * dx - dy * dy);
+            node.quadrupole[1] += mass * 3.0 * dx * dy;
+            node.quadrupole[2] += mass * (2.0 * dy * dy - dx * dx);
+        };
+        if (node.is_leaf())
         {
-            m = particle->m;
-            center = {particle->x, particle->y};
+            for (auto k = node.first; k < node.first + node.count; ++k)
+            {
+                add(sm[k], sx[k] - node.center[0], sy[k] - node.center[1]);
+            }
         }
         else
         {
-            m = 0.0;
-            center = {0.0, 0.0};
-            if (ne)
+            for (auto c : node.children)
+            {
+                if (c >= 0)
+                {
+                    const auto &child = pool[c];
+                    add(child.m, child.center[0] - node.center[0], child.center[1] - node.center[1]);
+                    node.quadrupole[0] += child.quadrupole[0];
+                    node.quadrupole[1] += child.quadrupole[1];
+                    node.quadrupole[2] += child.quadrupole[2];
+                }
+            }
+        }
+    }
+
+    /**
+     * Accumulates the quadrupole correction to the far-field acceleration exerted by a cell.
+     *
+     * Arguments:
+     *     node: the cell
+     *     dx, dy: offset from the particle to the cell's centre of mass
+     *     eps2: squared softening length
+     *     ax, ay: acceleration to accumulate into
+     */
+    static void _quadrupole_force(const QuadNode &node, const double dx, const double dy, const double eps2, double &ax, double &ay)
+    {
+        const auto &q = node.quadrupole;
+        double r2 = dx * dx + dy * dy + eps2;
+        double inv_r2 = 1.0 / r2;
+        double inv_r5 = inv_r2 * inv_r2 / std::sqrt(r2);
+        double qx = q[0] * dx + q[1] * dy;
+        double qy = q[1] * dx + q[2] * dy;
+        double s = 2.5 * (dx * qx + dy * qy) * inv_r2;
+        ax += G * inv_r5 * (s * dx - qx);
+        ay += G * inv_r5 * (s * dy - qy);
+    }
+
+    /**
+     * Accumulates the acceleration on one particle by walking the tree. The walk is a single loop
+     * over the threaded nodes: a leaf is interacted with directly, as one block of its gathered
+     * particles, and a cell far enough away acts as a point mass at its centre of mass (plus its
+     * quadrupole when use_quadrupole is set); both are then skipped past, while any other cell
+     * is opened. Kernels with a cutoff also skip past every cell lying wholly beyond it.
+     *
+     * Arguments:
+     *     kernel: the gravity kernel to evaluate interactions with
+     *     k: position of the particle in the sorted order
+     *     ax, ay: acceleration to accumulate into
+     *
+     * Returns:
+     *     number of nodes the walk visited
+     */
+    template <typename K>
+    std::size_t force(const K &kernel, const std::int32_t k, double &ax, double &ay) const
+    {
+        auto x = sx[k];
+        auto y = sy[k];
+        std::size_t visits = 0;
+        for (std::int32_t n = nodes.empty() ? -1 : 0; n >= 0; ++visits)
+        {
+            const auto &node = nodes[n];
+            if constexpr (requires { kernel.cutoff; })
+            {
+                // a kernel with a finite reach has nothing to say to cells entirely beyond it
+                double bx = std::max({node.ll[0] - x, 0.0, x - node.ll[0] - node.width});
+                double by = std::max({node.ll[1] - y, 0.0, y - node.ll[1] - node.width});
+                if (bx * bx + by * by > kernel.cutoff * kernel.cutoff)
+                {
+                    n = node.skip;
+                    continue;
+                }
+            }
+            if (node.next == node.skip)
             {
-                ne->get_cogs();
-                center[0] += ne->center[0] * ne->m;
-                center[1] += ne->center[1] * ne->m;
-                m += ne->m;
+                auto first = node.first;
+                auto end = node.first + node.count;
+                if (k >= first && k < end)
+                {
+                    // skip the particle itself by interacting with the blocks on either side of it
+                    kernel(x, y, &sx[first], &sy[first], &sm[first], k - first, ax, ay);
+                    kernel(x, y, &sx[k + 1], &sy[k + 1], &sm[k + 1], end - k - 1, ax, ay);
+                }
+                else
+                {
+                    kernel(x, y, &sx[first], &sy[first], &sm[first], node.count, ax, ay);
+                }
+                n = node.skip;
+                continue;
             }
-            if (nw)
+
+            double dx = node.center[0] - x;
+            double dy = node.center[1] - y;
+
+            // width / d < theta, without the square root; at the larger angles quadrupoles allow, the
+            // cell is also widened by how far its centre of mass sits from its middle, so that no
+            // particle inside it (or just beside it) treats it as distant
+            auto reach = node.width;
+            if (use_quadrupole)
             {
-                nw->get_cogs();
-                center[0] += nw->center[0] * nw->m;
-                center[1] += nw->center[1] * nw->m;
-                m += nw->m;
+                reach += theta * std::hypot(node.center[0] - node.ll[0] - 0.5 * node.width, node.center[1] - node.ll[1] - 0.5 * node.width);
             }
-            if (sw)
+            if (reach * reach < theta * theta * (dx * dx + dy * dy))
             {
-                sw->get_cogs();
-                center[0] += sw->center[0] * sw->m;
-                center[1] += sw->center[1] * sw->m;
-                m += sw->m;
+                kernel(dx, dy, node.m, ax, ay);
+                if (use_quadrupole)
+                {
+                    _quadrupole_force(node, dx, dy, kernel.eps2, ax, ay);
+                }
+                n = node.skip;
             }
-            if (se)
+            else
             {
-                se->get_cogs();
-                center[0] += se->center[0] * se->m;
-                center[1] += se->center[1] * se->m;
-                m += se->m;
+                n = node.next;
             }
-            center[0] /= m;
-            center[1] /= m;
         }
+        return visits;
     }
 
-   void force(Particle &e)
-   {
-        if (particle)
+    /**
+     * Cuts the tree into groups for group_force: the largest cells holding no more than
+     * group_size particles, and any leaves larger than that.
+     */
+    void collect_groups(const std::size_t group_size)
+    {
+        groups.clear();
+        for (std::int32_t n = nodes.empty() ? -1 : 0; n >= 0;)
         {
-            if (particle != &e)
+            const auto &node = nodes[n];
+            if (node.next == node.skip || static_cast<std::size_t>(node.count) <= group_size)
             {
-               e.force(*particle);
+                groups.push_back(n);
+                n = node.skip;
+            }
+            else
+            {
+                n = node.next;
             }
         }
-        else
+    }
+
+    /**
+     * Accumulates the acceleration on every particle of a group with a single walk of the tree
+     * (Barnes' grouping). A cell is accepted only if it passes the opening test from the point
+     * of the group's box nearest its centre of mass, so the walk is valid for every member at
+     * once and at least as strict as their own walks would be. The accepted cells and the
+     * particles of the leaves that were opened make up one interaction list, which every member
+     * then sums over as a single block. With single precision and the fast kernel the list is
+     * kept in single precision, as offsets from the middle of the group.
+     *
+     * Arguments:
+     *     kernel: the gravity kernel to evaluate interactions with
+     *     g: the group's node
+     *     list: scratch space for the interaction list
+     *     ax, ay: accelerations to accumulate into, indexed by particle
+     *
+     * Returns:
+     *     number of nodes the walk visited
+     */
+    template <typename K>
+    std::size_t group_force(const K &kernel, const std::int32_t g, InteractionList &list, double *ax, double *ay) const
+    {
+        const auto &group = nodes[g];
+        auto x0 = group.ll[0];
+        auto y0 = group.ll[1];
+        auto x1 = x0 + group.width;
+        auto y1 = y0 + group.width;
+        list.single = precision == Precision::single && std::is_same_v<K, FastKernel>;
+        list.origin = {x0 + 0.5 * group.width, y0 + 0.5 * group.width};
+        list.clear();
+        std::size_t visits = 0;
+        [[maybe_unused]] std::int32_t covered = 0;  // members in the group's own leaves
+        for (std::int32_t n = 0; n >= 0; ++visits)
         {
-            double dx = center[0] - e.x;
-            double dy = center[1] - e.y;
-            double d = std::hypot(dx, dy);
+            const auto &node = nodes[n];
+            if constexpr (requires { kernel.cutoff; })
+            {
+                double bx = std::max({node.ll[0] - x1, 0.0, x0 - node.ll[0] - node.width});
+                double by = std::max({node.ll[1] - y1, 0.0, y0 - node.ll[1] - node.width});
+                if (bx * bx + by * by > kernel.cutoff * kernel.cutoff)
+                {
+                    n = node.skip;
+                    continue;
+                }
+            }
+            if (node.next == node.skip)
+            {
+                if (node.first >= group.first && node.first < group.first + group.count)
+                {
+                    list.own.push_back({node.first, node.count, static_cast<std::int32_t>(list.size())});
+                    covered += node.count;
+                }
+                for (auto k = node.first; k < node.first + node.count; ++k)
+                {
+                    list.push(sx[k], sy[k], sm[k]);
+                }
+                n = node.skip;
+                continue;
+            }
 
-            if ((ur[0] - ll[0]) / d < theta)
+            // the group's ancestors hold its own particles, so they are always opened even when
+            // their centre of mass lies outside the group's box
+            bool ancestor = node.first <= group.first && group.first + group.count <= node.first + node.count;
+            // offset from the centre of mass to the nearest point of the group's box
+            double dx = std::clamp(node.center[0], x0, x1) - node.center[0];
+            double dy = std::clamp(node.center[1], y0, y1) - node.center[1];
+            auto reach = node.width;
+            if (use_quadrupole)
             {
-                e.force(dx, dy, m);
+                reach += theta * std::hypot(node.center[0] - node.ll[0] - 0.5 * node.width, node.center[1] - node.ll[1] - 0.5 * node.width);
             }
-            else
+            if (!ancestor && reach * reach < theta * theta * (dx * dx + dy * dy))
             {
-                if (ne)
+                list.push(node.center[0], node.center[1], node.m);
+                if (use_quadrupole)
                 {
-                    ne->force(e);
+                    list.cells.push_back(n);
                 }
-                if (nw)
+                n = node.skip;
+            }
+            else
+            {
+                n = node.next;
+            }
+        }
+
+        // every member must have been reached through the group's own leaves, or it gets no force
+        assert(covered == group.count);
+        auto size = static_cast<std::ptrdiff_t>(list.size());
+        for (const auto &[first, count, offset] : list.own)
+        {
+            for (std::int32_t i = 0; i < count; ++i)
+            {
+                auto k = first + i;
+                auto self = offset + i;
+                double gx = 0.0;
+                double gy = 0.0;
+                // skip the particle itself by interacting with the blocks on either side of it
+                if constexpr (std::is_same_v<K, FastKernel>)
                 {
-                    nw->force(e);
+                    if (list.single)
+                    {
+                        auto x = list.fx[self];
+                        auto y = list.fy[self];
+                        kernel(x, y, list.fx.data(), list.fy.data(), list.fm.data(), self, gx, gy);
+                        kernel(x, y, list.fx.data() + self + 1, list.fy.data() + self + 1, list.fm.data() + self + 1, size - self - 1, gx, gy);
+                    }
                 }
-                if (sw)
+                if (!list.single)
                 {
-                    sw->force(e);
+                    kernel(sx[k], sy[k], list.x.data(), list.y.data(), list.m.data(), self, gx, gy);
+                    kernel(sx[k], sy[k], list.x.data() + self + 1, list.y.data() + self + 1, list.m.data() + self + 1, size - self - 1, gx, gy);
                 }
-                if (se)
+                for (auto c : list.cells)
                 {
-                    se->force(e);
+                    _quadrupole_force(nodes[c], nodes[c].center[0] - sx[k], nodes[c].center[1] - sy[k], kernel.eps2, gx, gy);
                 }
+                ax[order[k]] += gx;
+                ay[order[k]] += gy;
             }
         }
+        return visits;
     }
 
-    void get_extents(std::vector<std::array<double, 4>> &extents)
+    void get_extents(std::vector<std::array<double, 4>> &extents) const
     {
-        if (particle)
+        for (const auto &node : nodes)
         {
-            extents.push_back({ll[0], ll[1], ur[0], ur[1]});
-        }
-        if (ne)
-        {
-            ne->get_extents(extents);
-        }
-        if (nw)
-        {
-            nw->get_extents(extents);
-        }
-        if (sw)
-        {
-            sw->get_extents(extents);
-        }
-        if (se)
-        {
-            se->get_extents(extents);
+            if (node.is_leaf())
+            {
+                extents.push_back({node.ll[0], node.ll[1], node.ll[0] + node.width, node.ll[1] + node.width});
+            }
         }
     }
 
-    void print()
+    /**
+     * Writes the extents of every occupied leaf into a preallocated buffer as consecutive
+     * (x0, y0, x1, y1) rows, advancing the output pointer past the rows written.
+     */
+    void get_extents(double *&out) const
     {
-        if (ne)
-        {
-            ne->print();
-        }
-        if (nw)
+        for (const auto &node : nodes)
         {
-            nw->print();
-        }
-        if (sw)
-        {
-            sw->print();
-        }
-        if (se)
-        {
-            se->print();
+            if (node.is_leaf())
+            {
+                *out++ = node.ll[0];
+                *out++ = node.ll[1];
+                *out++ = node.ll[0] + node.width;
+                *out++ = node.ll[1] + node.width;
+            }
         }
-        if (particle)
+    }
+
+    void print() const
+    {
+        for (const auto &node : nodes)
         {
-            std::cout << ll[0] << " " << ll[1] << " " << ur[0] << " " << ur[1] << std::endl;
+            if (node.is_leaf())
+            {
+                std::cout << node.ll[0] << " " << node.ll[1] << " " << node.ll[0] + node.width << " " << node.ll[1] + node.width << std::endl;
+            }
         }
     }
 };
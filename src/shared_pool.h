@@ -0,0 +1,175 @@
+#pragma once
+
+#include <algorithm>
+#include <condition_variable>
+#include <cstddef>
+#include <deque>
+#include <functional>
+#include <mutex>
+#include <thread>
+#include <vector>
+
+#include "parallel.h"
+
+/**
+ * A process-wide pool of worker threads that any number of systems can hand their tasks to, so
+ * the total thread count stays at the core count however many systems exist. Each call to
+ * SharedPool::run submits one job per worker index of its caller; callers are served in turn,
+ * one job at a time, so a system with many workers cannot crowd out the others, and no system
+ * ever has more jobs running than it has workers. The pool also runs whole pieces of work, such
+ * as the steps of SharedPool::submit, on the threads left idle by the batches, so they need no
+ * threads of their own.
+ */
+struct SharedPool
+{
+    /**
+     * The jobs of a single call to SharedPool::run; lives on the caller's stack until every job
+     * is done.
+     */
+    struct Batch
+    {
+        const Workers::Task *task {nullptr};  // task to run once per worker index
+        std::size_t count {0};                // number of worker indices
+        std::size_t next {0};                 // next worker index to hand out
+        std::size_t done {0};                 // number of jobs finished
+        std::condition_variable finished;     // signalled once the last job finishes
+    };
+
+    /**
+     * Starts the threads of the pool.
+     *
+     * Arguments:
+     *     nthreads: number of threads to use
+     */
+    SharedPool(const std::size_t nthreads)
+    {
+        threads.reserve(nthreads);
+        for (std::size_t i = 0; i < nthreads; ++i)
+        {
+            threads.emplace_back(&SharedPool::worker, std::ref(*this));
+        }
+    }
+
+    /**
+     * Destructor to let the threads finish the jobs already submitted and stop them.
+     */
+    ~SharedPool()
+    {
+        {
+            std::lock_guard<std::mutex> guard(mutex);
+            stopping = true;
+        }
+        work.notify_all();
+    }
+
+    /**
+     * Returns the pool shared by the whole process, started with one thread per core on first
+     * use. It is never destroyed: at exit its threads may still be finishing steps that wait on
+     * an interpreter that is already gone, so they are left to end with the process.
+     */
+    static SharedPool &instance()
+    {
+        static auto pool = new SharedPool(std::max(1u, std::thread::hardware_concurrency()));
+        return *pool;
+    }
+
+    /**
+     * Runs a task once for every worker index below count and waits for every run to finish.
+     *
+     * Arguments:
+     *     task: called with each worker index
+     *     count: number of worker indices
+     */
+    void run(const Workers::Task &task, const std::size_t count)
+    {
+        if (count == 0)
+        {
+            return;
+        }
+        Batch batch;
+        batch.task = &task;
+        batch.count = count;
+        std::unique_lock<std::mutex> guard(mutex);
+        batches.push_back(&batch);
+        work.notify_all();
+        // the caller works through its own batch alongside the pool, so the batch finishes even
+        // when every pool thread is busy, as it is when the caller is one of them
+        while (batch.next < batch.count)
+        {
+            auto w = batch.next++;
+            if (batch.next == batch.count)
+            {
+                batches.erase(std::find(batches.begin(), batches.end(), &batch));
+            }
+            guard.unlock();
+            task(w);
+            guard.lock();
+            ++batch.done;
+        }
+        batch.finished.wait(guard, [&batch]() { return batch.done == batch.count; });
+    }
+
+    /**
+     * Queues a piece of work to run on one of the pool's threads once no batch is waiting for
+     * one, and returns without waiting for it.
+     *
+     * Arguments:
+     *     piece: the work to run; may itself call SharedPool::run
+     */
+    void submit(std::function<void(void)> piece)
+    {
+        {
+            std::lock_guard<std::mutex> guard(mutex);
+            pieces.push_back(std::move(piece));
+        }
+        work.notify_one();
+    }
+
+    /**
+     * Loop run by every thread: takes the batch at the front of the queue, starts its next job
+     * and, if it has more, moves it to the back so the other batches get their turn first. With
+     * no batch queued, it runs the oldest submitted piece instead.
+     */
+    void worker()
+    {
+        std::unique_lock<std::mutex> guard(mutex);
+        while (true)
+        {
+            work.wait(guard, [this]() { return stopping || !batches.empty() || !pieces.empty(); });
+            if (batches.empty())
+            {
+                if (pieces.empty())
+                {
+                    break;
+                }
+                auto piece = std::move(pieces.front());
+                pieces.pop_front();
+                guard.unlock();
+                piece();
+                guard.lock();
+                continue;
+            }
+            auto batch = batches.front();
+            batches.pop_front();
+            auto w = batch->next++;
+            if (batch->next < batch->count)
+            {
+                batches.push_back(batch);
+            }
+            guard.unlock();
+            (*batch->task)(w);
+            guard.lock();
+            if (++batch->done == batch->count)
+            {
+                batch->finished.notify_one();
+            }
+        }
+    }
+
+    std::mutex mutex;                              // guards the queues and the progress of every batch
+    std::condition_variable work;                  // signalled when work is queued or the pool stops
+    std::deque<Batch*> batches;                    // batches with jobs left to start, in the order they are served
+    std::deque<std::function<void(void)>> pieces;  // submitted work waiting for an idle thread
+    bool stopping = false;                         // set once the pool is being destroyed
+    std::vector<std::jthread> threads;             // thread pool
+};
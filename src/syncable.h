@@ -7,6 +7,8 @@
 #include <thread>
 #include <vector>
 
+#include "affinity.h"
+
 /**
  * A thread synchronization wrapper that keeps any number of callables in lockstep with eachother.
  * A pair of std::barrier's are used to keep threads synchronized with a "driver" thread calling
@@ -34,8 +36,9 @@ struct Syncable
      * 
      * Arguments:
      *     callables: set of functions to assign to each thread
+     *     cpus: CPU to pin each thread to; empty leaves the threads unpinned
      */
-    Syncable(std::vector<std::function<void(void)>> callables):
+    Syncable(std::vector<std::function<void(void)>> callables, const std::vector<int> &cpus = {}):
         num_threads(callables.size()),
         sync_point_1(callables.size()+1),
         sync_point_2(callables.size()+1)
@@ -46,16 +49,23 @@ struct Syncable
             threads.emplace_back(
                 &Syncable::worker,
                 std::ref(*this),
-                callables[i]
+                callables[i],
+                cpus.empty() ? -1 : cpus[i]
             );
         }
     }
 
     /**
-     * Destructor to disable the lock and unblock the threads to synchronize.
+     * Destructor to disable the lock and unblock the threads to synchronize. A pool whose threads
+     * were never created, such as one whose owner threw before initializing it, has nothing to
+     * unblock.
      */
     ~Syncable()
     {
+        if (threads.empty())
+        {
+            return;
+        }
         lock = false;
         sync_point_2.arrive_and_drop();
         sync_point_1.arrive_and_wait();
@@ -66,8 +76,9 @@ struct Syncable
      *
      * Arguments:
      *     callables: set of functions to assign to each thread
+     *     cpus: CPU to pin each thread to; empty leaves the threads unpinned
      */
-    void initialize(std::vector<std::function<void(void)>> callables)
+    void initialize(std::vector<std::function<void(void)>> callables, const std::vector<int> &cpus = {})
     {
         for (std::size_t i = 0; i < num_threads; ++i)
         {
@@ -76,7 +87,8 @@ struct Syncable
                     std::bind(
                         &Syncable::worker,
                         std::ref(*this),
-                        callables[i]
+                        callables[i],
+                        cpus.empty() ? -1 : cpus[i]
                     )
                 )
             );
@@ -102,10 +114,17 @@ struct Syncable
      *
      * Arguments:
      *     callable: function to execute and synchronize
+     *     cpu: CPU to pin the thread to before its first run; negative leaves it unpinned
      */
-    void worker(std::function<void(void)> callable)
+    void worker(std::function<void(void)> callable, const int cpu)
     {
-        while (lock.load())
+        if (cpu >= 0)
+        {
+            pin_current_thread(cpu);
+        }
+        // always park on the first sync-point, even when the lock has already been released, so
+        // that the destructor's arrival there cannot be left waiting on a late worker
+        while (true)
         {
             sync_point_1.arrive_and_wait();
             if (!lock.load())